@@ -1,12 +1,10 @@
-from fastapi import FastAPI, Form, Request
+from fastapi import APIRouter, Form, Request
 from fastapi.responses import HTMLResponse
-from fastapi.templating import Jinja2Templates
-from fastapi.staticfiles import StaticFiles
 from database import SessionLocal, User
+from auth import invalidate_user
+from common import templates, desk_app
 
-app = FastAPI()
-templates = Jinja2Templates(directory="templates")
-app.mount("/static", StaticFiles(directory="static"), name="static")
+router = APIRouter()
 
 # Function to retrieve all users from the database
 def get_users():
@@ -26,19 +24,20 @@ def add_user(username: str, password: str, designation: str):
         db.add(new_user)
         db.commit()
         db.close()
+        invalidate_user()
         return True, "User added successfully"
     except Exception as e:
         db.rollback()
         db.close()
         return False, f"Failed to add user: {str(e)}"
 
-@app.get("/", response_class=HTMLResponse)
+@router.get("/", response_class=HTMLResponse)
 async def render_add_user_form(request: Request, message: str = None):
     return templates.TemplateResponse("add_user.html", {"request": request, "message": message})
 
 # Route to handle the form submission and add the new user to the database
-@app.post("/add_user/")
-async def add_new_user(request: Request, username: str = Form(...), password: str = Form(...), designation: str = Form(...)):
+@router.post("/add_user/")
+def add_new_user(request: Request, username: str = Form(...), password: str = Form(...), designation: str = Form(...)):
     success, message = add_user(username, password, designation)
     if success:
         return templates.TemplateResponse("add_user.html", {"request": request, "message": message})
@@ -46,12 +45,14 @@ async def add_new_user(request: Request, username: str = Form(...), password: st
         return templates.TemplateResponse("add_user.html", {"request": request, "message": message}, status_code=400)
 
 # Route to display all users
-@app.get("/users/", response_class=HTMLResponse)
-async def display_users(request: Request):
+@router.get("/users/", response_class=HTMLResponse)
+def display_users(request: Request):
     users = get_users()
     return templates.TemplateResponse("users.html", {"request": request, "users": users})
 
 
+app = desk_app(router)
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=5000)
\ No newline at end of file
@@ -1,86 +1,332 @@
-from fastapi import FastAPI, Depends, Request, Form, HTTPException, File, UploadFile, APIRouter
+from fastapi import Depends, Request, Form, HTTPException, File, UploadFile, APIRouter, WebSocket, WebSocketDisconnect
 from fastapi import Query, Path
-from typing import List  # Add this import
+from typing import List, Optional  # Add this import
 from fastapi.responses import RedirectResponse, HTMLResponse, JSONResponse
-from fastapi.templating import Jinja2Templates
-from fastapi.staticfiles import StaticFiles
-from sqlalchemy.orm import Session
-from sqlalchemy import func, desc
-from database import SessionLocal, engine, Master, BookingInfo, Transport, Schedule, Transport, Bus, Plane, Train, GroupInfo, Group, ProcessedMaster, User
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import func, desc, select, update, text, bindparam, DateTime
+from database import Master, ArrivalEvent, User, get_async_db, fetch_master_async, read_counter_async, master_cache, AsyncSessionLocal
+from auth import get_current_user, get_websocket_user, issue_session, clear_session
+from fastapi.concurrency import run_in_threadpool
+import json
+import re
+from common import templates, desk_url, desk_app
+from events import bus, publish, master_summary, sse_stream, EVENT_TYPES
+from fastapi.responses import StreamingResponse
 import os
 import csv
 import io
 from datetime import datetime
 
-app = FastAPI()
-
-app.mount("/static", StaticFiles(directory="static"), name="static")
-
-templates = Jinja2Templates(directory="templates")
-
-# Dependency to get the DB session
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+router = APIRouter()
 
 # Login route
-@app.get("/")
+@router.get("/")
 def login_form(request: Request):
     return templates.TemplateResponse("login.html", {"request": request})
 
-@app.post("/login/")
-async def login(request: Request, username: str = Form(...), password: str = Form(...), db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.username == username).first()
+@router.post("/login/")
+async def login(request: Request, username: str = Form(...), password: str = Form(...), db: AsyncSession = Depends(get_async_db)):
+    user = (await db.execute(select(User).where(User.username == username))).scalars().first()
     if user and user.password == password:
-        response = RedirectResponse(url="/mark-as-arrived-form/", status_code=303)
-        response.set_cookie(key="username", value=username)
+        response = RedirectResponse(url=desk_url(request, "/mark-as-arrived-form/"), status_code=303)
+        issue_session(response, user)
         return response
     return templates.TemplateResponse("login.html", {"request": request, "error": "Invalid username or password"})
 
 # Logout route
-@app.get("/logout/")
+@router.get("/logout/")
 async def logout(request: Request):
-    response = RedirectResponse(url="/login/", status_code=303)
-    response.delete_cookie("username")
+    response = RedirectResponse(url=desk_url(request, "/login/"), status_code=303)
+    clear_session(response)
     return response
 
-# Get current user
-def get_current_user(request: Request, db: Session = Depends(get_db)):
-    username = request.cookies.get("username")
-    if not username:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    user = db.query(User).filter(User.username == username).first()
-    if not user:
-        raise HTTPException(status_code=401, detail="User not found")
-    return user
-
-@app.get("/mark-as-arrived/")
-async def mark_as_arrived(its: int, db: Session = Depends(get_db)):
-    master = db.query(Master).filter(Master.ITS == its).first()
+@router.get("/mark-as-arrived/")
+async def mark_as_arrived(request: Request, its: int, db: AsyncSession = Depends(get_async_db)):
+    master = await fetch_master_async(db, its)
     if master:
+        newly_arrived = not master.arrived
         master.arrived = True
         master.timestamp = datetime.now()
-        db.commit()
-        db.refresh(master)
+        await db.commit()
+        if newly_arrived:
+            publish("arrival", masters=[master_summary(master)], arrived_count=await read_counter_async(db, "arrived"))
         message = f"ITS {its} marked as arrived successfully"
     else:
         message = f"No record found for ITS {its}"
-    return RedirectResponse(url=f"/mark-as-arrived-form/?its={its}&message={message}")
+    return RedirectResponse(url=desk_url(request, f"/mark-as-arrived-form/?its={its}&message={message}"))
 
-@app.get("/mark-as-arrived-form/")
-async def get_mark_as_arrived_form(request: Request, its: int = None, message: str = None, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    master = db.query(Master).filter(Master.ITS == its).first()
-    arrived_count = db.query(Master).filter(Master.arrived == True).count()
+@router.get("/mark-as-arrived-form/")
+async def get_mark_as_arrived_form(request: Request, its: int = None, message: str = None, db: AsyncSession = Depends(get_async_db), current_user: User = Depends(get_current_user)):
+    master = await fetch_master_async(db, its)
+    arrived_count = await read_counter_async(db, "arrived")
     return templates.TemplateResponse("arrive_.html", {"request": request, "master": master, "message": message, "arrived_count": arrived_count})
 
 
-@app.get("/arrived-list/", response_class=HTMLResponse)
-async def arrived_list(request: Request, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    arrived_masters = db.query(Master).filter(Master.arrived == True).all()
-    return templates.TemplateResponse("arrived_list.html", {"request": request, "arrived_masters": arrived_masters})
+# Batch arrivals: a bus unloads dozens of people at once, so scans are
+# marked together in one UPDATE instead of a GET and a redirect per ITS
+ARRIVAL_BATCH_MAX = int(os.getenv("ARRIVAL_BATCH_MAX", 500))
+
+
+def parse_scans(scans) -> tuple:
+    """
+    Split scanner input (a list, or text separated by whitespace or commas)
+    into ITS numbers, in order and without repeats, and entries that
+    aren't numbers.
+    """
+    if isinstance(scans, (str, int)):
+        scans = [scans]
+    numbers, invalid = [], []
+    for scan in scans:
+        for value in re.split(r"[\s,;]+", str(scan).strip()):
+            if not value:
+                continue
+            if value.isdigit():
+                numbers.append(int(value))
+            else:
+                invalid.append(value)
+    return list(dict.fromkeys(numbers)), invalid
+
+
+async def mark_arrived(db: AsyncSession, scans) -> dict:
+    """
+    Mark every scanned ITS as arrived. Each ITS is reported as "marked",
+    "already_arrived", "unknown" or "invalid", along with the new arrival
+    count.
+    """
+    numbers, invalid = parse_scans(scans)
+    if len(numbers) > ARRIVAL_BATCH_MAX:
+        raise ValueError(f"At most {ARRIVAL_BATCH_MAX} ITS numbers per batch")
+    marked, existing = {}, set()
+    if numbers:
+        # RETURNING tells us which rows this statement changed, so two desks
+        # scanning the same person can't both report "marked"
+        rows = (await db.execute(
+            update(Master.__table__)
+            .where(Master.ITS.in_(numbers), Master.arrived.isnot(True))
+            .values(arrived=True, timestamp=datetime.now())
+            .returning(Master.ITS, Master.first_name, Master.middle_name, Master.last_name, Master.timestamp)
+        )).all()
+        marked = {row.ITS: row for row in rows}
+        rest = [its for its in numbers if its not in marked]
+        if rest:
+            existing = set((await db.execute(select(Master.ITS).where(Master.ITS.in_(rest)))).scalars())
+        await db.commit()
+        master_cache.invalidate_many(marked)
+
+    results = []
+    for its in numbers:
+        status = "marked" if its in marked else "already_arrived" if its in existing else "unknown"
+        results.append({"its": its, "status": status})
+    results.extend({"its": value, "status": "invalid"} for value in invalid)
+    arrived_count = await read_counter_async(db, "arrived")
+    if marked:
+        publish("arrival", masters=[master_summary(row) for row in marked.values()], arrived_count=arrived_count)
+    return {
+        "results": results,
+        "marked": len(marked),
+        "arrived_count": arrived_count,
+    }
+
+
+@router.post("/mark-as-arrived/batch/")
+async def mark_as_arrived_batch(request: Request, db: AsyncSession = Depends(get_async_db), current_user: User = Depends(get_current_user)):
+    """
+    Takes {"its": [...]} as JSON, or an "its" form field of scans separated
+    by whitespace or commas.
+    """
+    if request.headers.get("content-type", "").startswith("application/json"):
+        try:
+            scans = (await request.json()).get("its", [])
+        except (ValueError, AttributeError):
+            raise HTTPException(status_code=400, detail='Expected {"its": [...]}')
+    else:
+        scans = (await request.form()).get("its", "")
+    try:
+        return await mark_arrived(db, scans)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@router.websocket("/mark-as-arrived/ws")
+async def mark_as_arrived_stream(websocket: WebSocket):
+    """
+    Scanner stream: each message is one or more ITS numbers (plain text or
+    a JSON list) and is answered with the same body as the batch endpoint.
+    """
+    user = await run_in_threadpool(get_websocket_user, websocket)
+    if user is None:
+        await websocket.close(code=1008)
+        return
+    await websocket.accept()
+    try:
+        while True:
+            message = await websocket.receive_text()
+            try:
+                scans = json.loads(message) if message.lstrip().startswith("[") else message
+                async with AsyncSessionLocal() as db:
+                    await websocket.send_json(await mark_arrived(db, scans))
+            except ValueError as e:
+                await websocket.send_json({"error": str(e)})
+    except WebSocketDisconnect:
+        pass
+
+
+# Live dashboard: the page shows the latest arrivals, then follows the event
+# stream, so it never reloads the full arrived list
+LIVE_RECENT = int(os.getenv("LIVE_RECENT", 50))
+
+
+@router.get("/events/")
+async def event_stream(
+    request: Request,
+    types: Optional[str] = Query(None, description="Comma separated event types"),
+    after: Optional[int] = Query(None, description="Last event id already seen"),
+    current_user: User = Depends(get_current_user),
+):
+    wanted = [name.strip() for name in types.split(",") if name.strip()] if types else None
+    unknown = [name for name in wanted or [] if name not in EVENT_TYPES]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown event types: {', '.join(unknown)}")
+    # A reconnecting EventSource sends the id of the last event it received
+    last_event_id = request.headers.get("last-event-id")
+    if last_event_id and last_event_id.isdigit():
+        after = int(last_event_id)
+    return StreamingResponse(
+        sse_stream(after, wanted),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.get("/live/", response_class=HTMLResponse)
+async def live_dashboard(request: Request, db: AsyncSession = Depends(get_async_db), current_user: User = Depends(get_current_user)):
+    # Read the event id first: anything published after it reaches the page
+    # through the stream, even if it also made it into the snapshot
+    last_event_id = bus.stats()["last_id"]
+    recent = (await db.execute(
+        select(Master.ITS, Master.first_name, Master.middle_name, Master.last_name, Master.timestamp)
+        .where(Master.arrived == True)
+        .order_by(Master.timestamp.desc())
+        .limit(LIVE_RECENT)
+    )).all()
+    arrived_count = await read_counter_async(db, "arrived")
+    return templates.TemplateResponse("live_arrivals.html", {
+        "request": request,
+        "recent": [master_summary(row) for row in recent],
+        "arrived_count": arrived_count,
+        "last_event_id": last_event_id,
+        "recent_limit": LIVE_RECENT,
+    })
+
+
+# Arrived list, read from the arrival_event log one page at a time. Clients
+# that already hold a page ask for ?after=<last id> and get only newer rows.
+ARRIVED_PAGE_SIZE = int(os.getenv("ARRIVED_PAGE_SIZE", 100))
+MAX_ARRIVED_PAGE_SIZE = 1000
+HISTOGRAM_BUCKET_MINUTES = int(os.getenv("HISTOGRAM_BUCKET_MINUTES", 15))
+
+# strftime('%s') and 'unixepoch' both treat the stored local time as UTC,
+# so buckets line up with the wall clock
+ARRIVAL_HISTOGRAM_SQL = text(
+    "SELECT datetime(CAST(strftime('%s', arrived_at) AS INTEGER) / :seconds * :seconds, 'unixepoch') AS start, "
+    "count(*) AS arrivals "
+    "FROM arrival_event "
+    "WHERE (:since IS NULL OR arrived_at >= :since) AND (:until IS NULL OR arrived_at < :until) "
+    "GROUP BY 1 ORDER BY 1"
+).bindparams(bindparam("since", type_=DateTime), bindparam("until", type_=DateTime))
+
+
+async def arrivals_page(db: AsyncSession, since: Optional[datetime], until: Optional[datetime], after: Optional[int], limit: int) -> tuple:
+    """
+    Arrivals in id (arrival) order, optionally within [since, until) and
+    after an event id. Returns (rows, has_more).
+    """
+    statement = (
+        select(
+            ArrivalEvent.id, ArrivalEvent.ITS, ArrivalEvent.arrived_at,
+            Master.first_name, Master.middle_name, Master.last_name, Master.passport_No, Master.Visa_No,
+        )
+        .join(Master, Master.ITS == ArrivalEvent.ITS)
+        .order_by(ArrivalEvent.id)
+        .limit(limit + 1)
+    )
+    if since is not None:
+        statement = statement.where(ArrivalEvent.arrived_at >= since)
+    if until is not None:
+        statement = statement.where(ArrivalEvent.arrived_at < until)
+    if after is not None:
+        statement = statement.where(ArrivalEvent.id > after)
+    rows = (await db.execute(statement)).all()
+    return rows[:limit], len(rows) > limit
+
+
+async def arrival_histogram(db: AsyncSession, bucket_minutes: int, since: Optional[datetime], until: Optional[datetime]) -> list:
+    rows = await db.execute(ARRIVAL_HISTOGRAM_SQL, {"seconds": bucket_minutes * 60, "since": since, "until": until})
+    return [{"start": row.start, "arrivals": row.arrivals} for row in rows]
+
+
+@router.get("/arrived-list/", response_class=HTMLResponse)
+async def arrived_list(
+    request: Request,
+    since: Optional[datetime] = Query(None),
+    until: Optional[datetime] = Query(None),
+    after: Optional[int] = Query(None),
+    limit: int = Query(ARRIVED_PAGE_SIZE, ge=1, le=MAX_ARRIVED_PAGE_SIZE),
+    bucket: int = Query(HISTOGRAM_BUCKET_MINUTES, ge=1, le=24 * 60),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: User = Depends(get_current_user)
+):
+    arrivals, has_more = await arrivals_page(db, since, until, after, limit)
+    histogram = await arrival_histogram(db, bucket, since, until)
+    return templates.TemplateResponse("arrived_list.html", {
+        "request": request,
+        "arrivals": arrivals,
+        "has_more": has_more,
+        "histogram": histogram,
+        "since": since,
+        "until": until,
+        "limit": limit,
+        "bucket": bucket,
+    })
+
+
+@router.get("/arrivals/")
+async def arrivals_json(
+    since: Optional[datetime] = Query(None),
+    until: Optional[datetime] = Query(None),
+    after: Optional[int] = Query(None),
+    limit: int = Query(ARRIVED_PAGE_SIZE, ge=1, le=MAX_ARRIVED_PAGE_SIZE),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: User = Depends(get_current_user)
+):
+    arrivals, has_more = await arrivals_page(db, since, until, after, limit)
+    return {
+        "arrivals": [
+            {
+                "id": row.id,
+                "ITS": row.ITS,
+                "name": " ".join(part for part in (row.first_name, row.middle_name, row.last_name) if part),
+                "passport_No": row.passport_No,
+                "arrived_at": row.arrived_at.isoformat(),
+            }
+            for row in arrivals
+        ],
+        "last_id": arrivals[-1].id if arrivals else after,
+        "has_more": has_more,
+    }
+
+
+@router.get("/arrivals/histogram/")
+async def arrivals_histogram(
+    bucket: int = Query(HISTOGRAM_BUCKET_MINUTES, ge=1, le=24 * 60, description="Bucket width in minutes"),
+    since: Optional[datetime] = Query(None),
+    until: Optional[datetime] = Query(None),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: User = Depends(get_current_user)
+):
+    return {"bucket_minutes": bucket, "buckets": await arrival_histogram(db, bucket, since, until)}
+
+app = desk_app(router)
 
 if __name__ == "__main__":
     import uvicorn
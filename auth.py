@@ -0,0 +1,158 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import time
+from typing import Optional
+
+from fastapi import HTTPException, Request, WebSocket
+from fastapi.responses import Response
+
+from database import SessionLocal, User, LRUCache
+
+SESSION_COOKIE = "session"
+
+# Every desk process and worker must sign with the same key: browsers share
+# the session cookie across ports, so a cookie from one desk has to verify
+# on all of them. Without SESSION_SECRET the key is kept in
+# SESSION_SECRET_FILE, created by whichever process starts first.
+SESSION_SECRET_FILE = os.getenv("SESSION_SECRET_FILE", ".session_secret")
+
+
+def load_session_secret() -> bytes:
+    secret = os.getenv("SESSION_SECRET")
+    if secret:
+        return secret.encode()
+    if not os.path.exists(SESSION_SECRET_FILE):
+        # Write the whole key to a temp file, then link it into place: the
+        # link fails if another process got there first, so every process
+        # ends up reading the same complete key
+        tmp = f"{SESSION_SECRET_FILE}.{os.getpid()}.tmp"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(secrets.token_hex(32))
+            os.link(tmp, SESSION_SECRET_FILE)
+        except FileExistsError:
+            pass
+        finally:
+            os.unlink(tmp)
+    with open(SESSION_SECRET_FILE) as f:
+        secret = f.read().strip()
+    if not secret:
+        raise RuntimeError(f"{SESSION_SECRET_FILE} is empty; set SESSION_SECRET or delete the file")
+    return secret.encode()
+
+
+SESSION_SECRET = load_session_secret()
+SESSION_MAX_AGE = int(os.getenv("SESSION_MAX_AGE", 12 * 60 * 60))
+
+# Users change rarely; the TTL bounds how long a change made from another
+# process (admin.py, delete.py) takes to reach the desks
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 1000))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", 60))
+
+user_cache = LRUCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def _signature(payload: str) -> str:
+    return _b64encode(hmac.new(SESSION_SECRET, payload.encode(), hashlib.sha256).digest())
+
+
+def sign_session(user: User) -> str:
+    """
+    Build a signed session token carrying the user id and designation.
+    """
+    payload = _b64encode(json.dumps({
+        "uid": user.id,
+        "des": user.designation,
+        "iat": int(time.time()),
+    }, separators=(",", ":")).encode())
+    return f"{payload}.{_signature(payload)}"
+
+
+def read_session(token: Optional[str]) -> Optional[dict]:
+    """
+    Return the token's claims, or None if it is missing, forged or expired.
+    """
+    if not token or "." not in token:
+        return None
+    payload, signature = token.rsplit(".", 1)
+    if not hmac.compare_digest(signature, _signature(payload)):
+        return None
+    try:
+        claims = json.loads(_b64decode(payload))
+    except ValueError:
+        return None
+    if claims.get("iat", 0) + SESSION_MAX_AGE < time.time():
+        return None
+    return claims
+
+
+def issue_session(response: Response, user: User):
+    response.set_cookie(key=SESSION_COOKIE, value=sign_session(user), max_age=SESSION_MAX_AGE, httponly=True, samesite="lax")
+
+
+def clear_session(response: Response):
+    response.delete_cookie(SESSION_COOKIE)
+
+
+def load_user(user_id: int) -> Optional[User]:
+    user = user_cache.get(user_id)
+    if user is not None:
+        return user
+    db = SessionLocal()
+    try:
+        user = db.get(User, user_id)
+        if user is None:
+            return None
+        # Detach it fully loaded so it can be shared between requests
+        db.expunge(user)
+    finally:
+        db.close()
+    user_cache.put(user_id, user)
+    return user
+
+
+def invalidate_user(user_id: Optional[int] = None):
+    if user_id is None:
+        user_cache.clear()
+    else:
+        user_cache.invalidate(user_id)
+
+
+def get_current_user(request: Request) -> User:
+    claims = read_session(request.cookies.get(SESSION_COOKIE))
+    if not claims:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    user = load_user(claims["uid"])
+    if not user:
+        raise HTTPException(status_code=401, detail="User not found")
+    # A designation change takes effect on the next login
+    if user.designation != claims.get("des"):
+        raise HTTPException(status_code=401, detail="Session expired")
+    return user
+
+
+def get_websocket_user(websocket: WebSocket) -> Optional[User]:
+    """
+    get_current_user() for a WebSocket, which can't be answered with a 401:
+    returns None and lets the caller close the socket.
+    """
+    claims = read_session(websocket.cookies.get(SESSION_COOKIE))
+    if not claims:
+        return None
+    user = load_user(claims["uid"])
+    if not user or user.designation != claims.get("des"):
+        return None
+    return user
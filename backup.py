@@ -0,0 +1,607 @@
+"""
+Incremental online backups of the SQLite database.
+
+A snapshot is taken with SQLite's online backup API, which copies pages
+under a read transaction and so never blocks the desks writing in WAL mode.
+Each snapshot is then compared page by page with the previous one. Only
+the pages that changed are kept, in a delta file. Every BACKUP_FULL_EVERY
+snapshots a new full copy starts a new chain, and only the newest
+BACKUP_KEEP_CHAINS chains are kept.
+
+Only the stored snapshots are incremental. Every run that finds new
+commits still copies the whole database to a temporary file and hashes
+every page, so a run reads and writes about the size of the database.
+Runs with no commits since the last snapshot (PRAGMA data_version) are
+skipped without any copy. Reading only the changed WAL frames would need
+this job to own checkpointing for every connection, which lets the WAL
+grow without bound whenever backups stop.
+
+backups/manifest.json lists every snapshot in order. A snapshot is rebuilt
+by copying its chain's full file and replaying the deltas up to it.
+
+Every desk worker can restore, so the backup files are guarded by an
+flock on backups/.backup.lock as well as a thread lock: taking a snapshot
+or pruning holds it exclusively, rebuilding or opening a snapshot holds
+it shared.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import List, Optional
+
+from columnar import ColumnarFile, DEFAULT_COMPRESSION, write_columnar, diff_columnar
+from database import SEARCH_SYNC, engine, master_cache, apply_sqlite_pragmas
+from events import bus
+
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+BACKUP_FULL_EVERY = int(os.getenv("BACKUP_FULL_EVERY", 60))
+BACKUP_KEEP_CHAINS = int(os.getenv("BACKUP_KEEP_CHAINS", 24))
+# Columnar dumps (compact, compressed, one file per table) kept alongside
+# the page chains; they outlive the chains, so they cover older restores
+BACKUP_KEEP_COLUMNAR = int(os.getenv("BACKUP_KEEP_COLUMNAR", 7))
+# Pages copied per backup step; -1 copies everything in one step, which
+# under WAL only holds a read snapshot. Smaller steps restart whenever
+# another connection writes in between.
+BACKUP_STEP_PAGES = int(os.getenv("BACKUP_STEP_PAGES", -1))
+
+MANIFEST = "manifest.json"
+BACKUP_LOCK = ".backup.lock"
+SNAPSHOT_ID_FORMAT = "%Y%m%d%H%M%S%f"
+PAGE_HASHES = "pages.hash"
+COLUMNAR_DIR = "columnar"
+DIGEST_SIZE = 16
+
+# Delta file: header, then one (page number, page bytes) record per changed page
+DELTA_MAGIC = b"WGDELTA1"
+DELTA_HEADER = struct.Struct("<8sIII")  # magic, page size, page count, changed pages
+PAGE_NUMBER = struct.Struct("<I")
+
+_lock = threading.Lock()
+_source = None
+_last_data_version = None
+
+
+def backup_path(name: str) -> str:
+    return os.path.join(BACKUP_DIR, name)
+
+
+@contextmanager
+def backup_lock(shared: bool = False):
+    """
+    Hold the backup files against other threads and processes. Closing the
+    lock file releases the flock.
+    """
+    with _lock:
+        os.makedirs(BACKUP_DIR, exist_ok=True)
+        with open(backup_path(BACKUP_LOCK), "a") as handle:
+            fcntl.flock(handle, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            yield
+
+
+def load_manifest() -> dict:
+    try:
+        with open(backup_path(MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"snapshots": []}
+
+
+def _write_atomic(name: str, data: bytes):
+    tmp = backup_path(name + ".tmp")
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, backup_path(name))
+
+
+def save_manifest(manifest: dict):
+    _write_atomic(MANIFEST, json.dumps(manifest, indent=1).encode())
+
+
+def _source_connection() -> sqlite3.Connection:
+    # One long-lived read connection: PRAGMA data_version only tells us about
+    # commits made by other connections since this one last asked
+    global _source
+    if _source is None:
+        _source = sqlite3.connect(engine.url.database, check_same_thread=False)
+        # Same busy_timeout, cache and mmap settings as the pooled connections
+        apply_sqlite_pragmas(_source, None)
+    return _source
+
+
+def data_version() -> int:
+    return _source_connection().execute("PRAGMA data_version").fetchone()[0]
+
+
+def page_size_of(path: str) -> int:
+    with open(path, "rb") as f:
+        header = f.read(100)
+    size = struct.unpack(">H", header[16:18])[0]
+    return 65536 if size == 1 else size
+
+
+def copy_database(target_path: str):
+    # Full-size copy of the database; see the module docstring
+    target = sqlite3.connect(target_path)
+    try:
+        _source_connection().backup(target, pages=BACKUP_STEP_PAGES)
+    finally:
+        target.close()
+
+
+def _load_page_hashes() -> Optional[bytes]:
+    try:
+        with open(backup_path(PAGE_HASHES), "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def _diff_pages(copy_path: str, delta_path: Optional[str], previous: Optional[bytes], page_size: int):
+    """
+    Hash every page of the copy. If delta_path is given, write the pages whose
+    hash differs from `previous` to it. Returns (hashes, changed pages).
+    """
+    hashes = bytearray()
+    changed = 0
+    delta = open(delta_path, "wb") if delta_path else None
+    try:
+        if delta:
+            delta.write(DELTA_HEADER.pack(DELTA_MAGIC, page_size, 0, 0))
+        with open(copy_path, "rb") as f:
+            page_number = 0
+            while True:
+                page = f.read(page_size)
+                if not page:
+                    break
+                page_number += 1
+                offset = (page_number - 1) * DIGEST_SIZE
+                digest = hashlib.blake2b(page, digest_size=DIGEST_SIZE).digest()
+                hashes += digest
+                if delta and previous[offset:offset + DIGEST_SIZE] != digest:
+                    delta.write(PAGE_NUMBER.pack(page_number))
+                    delta.write(page)
+                    changed += 1
+        if delta:
+            delta.seek(0)
+            delta.write(DELTA_HEADER.pack(DELTA_MAGIC, page_size, page_number, changed))
+    finally:
+        if delta:
+            delta.close()
+    return bytes(hashes), changed
+
+
+def create_snapshot(force: bool = False) -> Optional[dict]:
+    """
+    Take a snapshot if anything was committed since the last one (or if
+    force is set). Returns the manifest entry, or None if nothing changed.
+    A snapshot copies and hashes the whole database even when it only
+    stores a small delta.
+    """
+    global _last_data_version
+    with backup_lock():
+        manifest = load_manifest()
+        snapshots = manifest["snapshots"]
+        version = data_version()
+        if snapshots and not force and version == _last_data_version:
+            return None
+
+        started = time.perf_counter()
+        snapshot_id = datetime.now().strftime(SNAPSHOT_ID_FORMAT)
+        copy_path = backup_path(f"{snapshot_id}.tmp")
+        copy_database(copy_path)
+        page_size = page_size_of(copy_path)
+
+        last = snapshots[-1] if snapshots else None
+        previous = _load_page_hashes() if last else None
+        chain_length = sum(1 for s in snapshots if last and s["base"] == last["base"])
+        full = (
+            previous is None
+            or last["page_size"] != page_size
+            or chain_length >= BACKUP_FULL_EVERY
+        )
+
+        if full:
+            file_name = f"{snapshot_id}.full.db"
+            hashes, changed = _diff_pages(copy_path, None, None, page_size)
+            os.replace(copy_path, backup_path(file_name))
+        else:
+            file_name = f"{snapshot_id}.delta"
+            hashes, changed = _diff_pages(copy_path, backup_path(file_name), previous, page_size)
+            os.remove(copy_path)
+            if changed == 0 and len(hashes) == len(previous):
+                os.remove(backup_path(file_name))
+                _last_data_version = version
+                return None
+
+        page_count = len(hashes) // DIGEST_SIZE
+        entry = {
+            "id": snapshot_id,
+            "kind": "full" if full else "delta",
+            "file": file_name,
+            "base": snapshot_id if full else last["base"],
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "page_size": page_size,
+            "page_count": page_count,
+            "pages": page_count if full else changed,
+            "bytes": os.path.getsize(backup_path(file_name)),
+            "seconds": round(time.perf_counter() - started, 3),
+        }
+        snapshots.append(entry)
+        prune(manifest)
+        _write_atomic(PAGE_HASHES, hashes)
+        save_manifest(manifest)
+        _last_data_version = version
+        print(f"Backup {entry['kind']} snapshot {snapshot_id}: {entry['pages']} pages, {entry['bytes']} bytes in {entry['seconds']}s")
+        return entry
+
+
+def prune(manifest: dict):
+    """
+    Keep the newest BACKUP_KEEP_CHAINS chains and delete the files of the rest.
+    """
+    bases = []
+    for snapshot in manifest["snapshots"]:
+        if snapshot["base"] not in bases:
+            bases.append(snapshot["base"])
+    keep = set(bases[-BACKUP_KEEP_CHAINS:])
+    kept = []
+    for snapshot in manifest["snapshots"]:
+        if snapshot["base"] in keep:
+            kept.append(snapshot)
+        else:
+            try:
+                os.remove(backup_path(snapshot["file"]))
+            except FileNotFoundError:
+                pass
+    manifest["snapshots"] = kept
+
+
+def snapshot_time(snapshot: dict) -> datetime:
+    return datetime.strptime(snapshot["id"], SNAPSHOT_ID_FORMAT)
+
+
+def find_snapshot(snapshot_id: Optional[str] = None, at: Optional[datetime] = None) -> dict:
+    """
+    Look a snapshot up by id, or pick the newest one taken at or before `at`
+    (point-in-time restore). With neither, return the latest snapshot.
+    """
+    snapshots = load_manifest()["snapshots"]
+    if not snapshots:
+        raise LookupError("No snapshots taken yet")
+    if snapshot_id is not None:
+        for snapshot in snapshots:
+            if snapshot["id"] == snapshot_id:
+                return snapshot
+        raise LookupError(f"Snapshot {snapshot_id} not found")
+    if at is not None:
+        earlier = [s for s in snapshots if snapshot_time(s) <= at]
+        if not earlier:
+            raise LookupError(f"No snapshot at or before {at.isoformat()}; the oldest is {snapshot_time(snapshots[0]).isoformat()}")
+        return earlier[-1]
+    return snapshots[-1]
+
+
+def list_snapshots() -> list:
+    return [
+        {**snapshot, "taken_at": snapshot_time(snapshot).isoformat()}
+        for snapshot in load_manifest()["snapshots"]
+    ]
+
+
+def apply_delta(delta_path: str, target):
+    with open(delta_path, "rb") as delta:
+        magic, page_size, page_count, changed = DELTA_HEADER.unpack(delta.read(DELTA_HEADER.size))
+        if magic != DELTA_MAGIC:
+            raise ValueError(f"{delta_path} is not a delta file")
+        for _ in range(changed):
+            (page_number,) = PAGE_NUMBER.unpack(delta.read(PAGE_NUMBER.size))
+            target.seek((page_number - 1) * page_size)
+            target.write(delta.read(page_size))
+
+
+def materialize(snapshot: dict, target_path: str) -> str:
+    """
+    Rebuild the database as it was at `snapshot` into target_path.
+    """
+    with backup_lock(shared=True):
+        snapshots = load_manifest()["snapshots"]
+        chain = [s for s in snapshots if s["base"] == snapshot["base"] and s["id"] <= snapshot["id"]]
+        if not chain or chain[-1]["id"] != snapshot["id"]:
+            raise LookupError(f"Snapshot {snapshot['id']} has been pruned")
+        shutil.copyfile(backup_path(chain[0]["file"]), target_path)
+        with open(target_path, "r+b") as target:
+            for entry in chain[1:]:
+                apply_delta(backup_path(entry["file"]), target)
+            target.truncate(snapshot["page_count"] * snapshot["page_size"])
+    return target_path
+
+
+def _quote(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+# Tables written by triggers on another table. Restoring that table makes
+# the triggers log every row again under new ids, so the log is restored
+# from the same snapshot right after it, replacing those rows in the same
+# transaction.
+RESTORE_DEPENDENTS = {"master": ["arrival_event"]}
+
+
+def with_dependents(table_names: List[str], available) -> List[str]:
+    """
+    table_names plus the logs that must follow them, each log after the
+    table that feeds it. Logs missing from an older snapshot are skipped.
+    """
+    dependents = [
+        dependent
+        for table_name in table_names
+        for dependent in RESTORE_DEPENDENTS.get(table_name, [])
+        if dependent in available
+    ]
+    return [name for name in table_names if name not in dependents] + list(dict.fromkeys(dependents))
+
+
+def restore_tables(table_names: List[str], snapshot_id: Optional[str] = None, at: Optional[datetime] = None) -> dict:
+    """
+    Replace the rows of every table in table_names with their rows in the
+    chosen snapshot. The rebuilt snapshot is attached to a pooled connection
+    and each table is copied with a single INSERT ... SELECT, all inside one
+    transaction, so either every table is restored or none is.
+
+    Restoring master also restores arrival_event with the snapshot's ids
+    (see RESTORE_DEPENDENTS). The arrival log then ends where the snapshot
+    does, so a client paging /arrivals/ past its last id must start over.
+    Live dashboards on this process get a "reset" event and reload.
+    """
+    started = time.perf_counter()
+    snapshot = find_snapshot(snapshot_id, at)
+    restore_path = materialize(snapshot, backup_path(f"restore-{snapshot['id']}.db"))
+    materialized = time.perf_counter()
+    rows = {}
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("ATTACH DATABASE ? AS snapshot", (restore_path,))
+        try:
+            available = {row[0] for row in cursor.execute("SELECT name FROM snapshot.sqlite_master WHERE type = 'table'")}
+            table_names = with_dependents(table_names, available)
+            columns = {}
+            for table_name in table_names:
+                exists = cursor.execute(
+                    "SELECT 1 FROM snapshot.sqlite_master WHERE type = 'table' AND name = ?", (table_name,)
+                ).fetchone()
+                if not exists:
+                    raise ValueError(f"Table {table_name} is not in snapshot {snapshot['id']}")
+                columns[table_name] = ", ".join(
+                    _quote(row[1]) for row in cursor.execute(f"PRAGMA main.table_info({_quote(table_name)})")
+                )
+                if not columns[table_name]:
+                    raise ValueError(f"Table {table_name} does not exist")
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                for table_name in table_names:
+                    cursor.execute(f"DELETE FROM main.{_quote(table_name)}")
+                    cursor.execute(
+                        f"INSERT INTO main.{_quote(table_name)} ({columns[table_name]}) "
+                        f"SELECT {columns[table_name]} FROM snapshot.{_quote(table_name)}"
+                    )
+                    rows[table_name] = cursor.rowcount
+                # Restoring master queues every row for the search index
+                for statement in SEARCH_SYNC:
+                    cursor.execute(statement)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        finally:
+            cursor.execute("DETACH DATABASE snapshot")
+            cursor.close()
+    finally:
+        conn.close()
+        os.remove(restore_path)
+    master_cache.clear()
+    bus.reset()
+    finished = time.perf_counter()
+    return {
+        "tables": table_names,
+        "snapshot": snapshot["id"],
+        "taken_at": snapshot_time(snapshot).isoformat(),
+        "rows": rows,
+        "timings": {
+            "materialize_seconds": round(materialized - started, 3),
+            "copy_seconds": round(finished - materialized, 3),
+            "total_seconds": round(finished - started, 3),
+        },
+    }
+
+
+def restore_table(table_name: str, snapshot_id: Optional[str] = None, at: Optional[datetime] = None) -> dict:
+    return restore_tables([table_name], snapshot_id, at)
+
+
+# Columnar dumps: backups/columnar/<snapshot id>/<table>.wcol plus a manifest
+
+def columnar_path(snapshot_id: str, name: str = "") -> str:
+    return os.path.join(BACKUP_DIR, COLUMNAR_DIR, snapshot_id, name)
+
+
+def list_columnar() -> list:
+    root = backup_path(COLUMNAR_DIR)
+    if not os.path.isdir(root):
+        return []
+    dumps = []
+    for snapshot_id in sorted(os.listdir(root)):
+        try:
+            with open(columnar_path(snapshot_id, MANIFEST)) as f:
+                dumps.append(json.load(f))
+        except FileNotFoundError:
+            # Still being written, or left behind by a failed dump
+            continue
+    return dumps
+
+
+def find_columnar(snapshot_id: Optional[str] = None, at: Optional[datetime] = None) -> dict:
+    dumps = list_columnar()
+    if not dumps:
+        raise LookupError("No columnar dumps written yet")
+    if snapshot_id is not None:
+        for dump in dumps:
+            if dump["snapshot"] == snapshot_id:
+                return dump
+        raise LookupError(f"Columnar dump {snapshot_id} not found")
+    if at is not None:
+        earlier = [d for d in dumps if datetime.fromisoformat(d["taken_at"]) <= at]
+        if not earlier:
+            raise LookupError(f"No columnar dump at or before {at.isoformat()}")
+        return earlier[-1]
+    return dumps[-1]
+
+
+def write_columnar_snapshot(snapshot_id: Optional[str] = None, compression: Optional[str] = None) -> dict:
+    """
+    Write every table of a snapshot (the latest by default) as a columnar
+    file, then drop all but the newest BACKUP_KEEP_COLUMNAR dumps.
+    """
+    started = time.perf_counter()
+    compression = compression or DEFAULT_COMPRESSION
+    snapshot = find_snapshot(snapshot_id)
+    directory = columnar_path(snapshot["id"])
+    os.makedirs(directory, exist_ok=True)
+    source_path = materialize(snapshot, backup_path(f"columnar-{snapshot['id']}.db"))
+    tables = {}
+    try:
+        conn = sqlite3.connect(source_path)
+        try:
+            # Virtual tables (the search index) and their shadow tables are
+            # rebuilt by triggers, so they are left out
+            table_names = [row[0] for row in conn.execute(
+                "SELECT name FROM sqlite_master AS t WHERE type = 'table' AND name NOT LIKE 'sqlite_%' "
+                "AND sql NOT LIKE 'CREATE VIRTUAL TABLE%' AND NOT EXISTS ("
+                "SELECT 1 FROM sqlite_master AS v WHERE v.type = 'table' AND v.sql LIKE 'CREATE VIRTUAL TABLE%' "
+                "AND t.name LIKE v.name || '\\_%' ESCAPE '\\')"
+            )]
+            for table_name in table_names:
+                cursor = conn.execute(f"SELECT * FROM {_quote(table_name)}")
+                names = [column[0] for column in cursor.description]
+                file_name = f"{table_name}.wcol"
+                footer = write_columnar(
+                    columnar_path(snapshot["id"], file_name), names, cursor, compression,
+                    meta={"table": table_name, "snapshot": snapshot["id"]},
+                )
+                tables[table_name] = {"file": file_name, "rows": footer["rows"], "bytes": footer["bytes"]}
+        finally:
+            conn.close()
+    finally:
+        os.remove(source_path)
+
+    manifest = {
+        "snapshot": snapshot["id"],
+        "taken_at": snapshot_time(snapshot).isoformat(),
+        "compression": compression,
+        "tables": tables,
+        "bytes": sum(table["bytes"] for table in tables.values()),
+        "seconds": round(time.perf_counter() - started, 3),
+    }
+    with open(columnar_path(snapshot["id"], MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=1)
+    prune_columnar()
+    print(f"Columnar dump of snapshot {snapshot['id']}: {len(tables)} tables, {manifest['bytes']} bytes in {manifest['seconds']}s")
+    return manifest
+
+
+def prune_columnar():
+    with backup_lock():
+        for dump in list_columnar()[:-BACKUP_KEEP_COLUMNAR]:
+            shutil.rmtree(columnar_path(dump["snapshot"]), ignore_errors=True)
+
+
+def restore_tables_columnar(table_names: List[str], snapshot_id: Optional[str] = None, at: Optional[datetime] = None) -> dict:
+    """
+    Same as restore_tables, but reads a columnar dump: the column files are
+    memory-mapped and inserted with executemany, all in one transaction.
+    """
+    started = time.perf_counter()
+    rows = {}
+    conn = engine.raw_connection()
+    sources = {}
+    try:
+        cursor = conn.cursor()
+        try:
+            columns = {}
+            # Pruning may delete the dump, but files already open stay readable
+            with backup_lock(shared=True):
+                dump = find_columnar(snapshot_id, at)
+                table_names = with_dependents(table_names, dump["tables"])
+                for table_name in table_names:
+                    if table_name not in dump["tables"]:
+                        raise ValueError(f"Table {table_name} is not in columnar dump {dump['snapshot']}")
+                    existing = {row[1] for row in cursor.execute(f"PRAGMA main.table_info({_quote(table_name)})")}
+                    if not existing:
+                        raise ValueError(f"Table {table_name} does not exist")
+                    sources[table_name] = ColumnarFile(columnar_path(dump["snapshot"], dump["tables"][table_name]["file"]))
+                    columns[table_name] = [name for name in sources[table_name].names if name in existing]
+            opened = time.perf_counter()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                for table_name, source in sources.items():
+                    names = columns[table_name]
+                    cursor.execute(f"DELETE FROM main.{_quote(table_name)}")
+                    cursor.executemany(
+                        f"INSERT INTO main.{_quote(table_name)} ({', '.join(_quote(n) for n in names)}) "
+                        f"VALUES ({', '.join('?' for _ in names)})",
+                        source.iter_rows(names),
+                    )
+                    rows[table_name] = source.rows
+                # Restoring master queues every row for the search index
+                for statement in SEARCH_SYNC:
+                    cursor.execute(statement)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        finally:
+            cursor.close()
+    finally:
+        for source in sources.values():
+            source.close()
+        conn.close()
+    master_cache.clear()
+    bus.reset()
+    finished = time.perf_counter()
+    return {
+        "tables": table_names,
+        "snapshot": dump["snapshot"],
+        "taken_at": dump["taken_at"],
+        "rows": rows,
+        "timings": {
+            "open_seconds": round(opened - started, 3),
+            "copy_seconds": round(finished - opened, 3),
+            "total_seconds": round(finished - started, 3),
+        },
+    }
+
+
+def diff_snapshots(table_name: str, key: str, old_id: str, new_id: Optional[str] = None) -> dict:
+    """
+    Compare a table between two columnar dumps (new defaults to the latest).
+    """
+    with backup_lock(shared=True):
+        old = find_columnar(old_id)
+        new = find_columnar(new_id)
+        for dump in (old, new):
+            if table_name not in dump["tables"]:
+                raise ValueError(f"Table {table_name} is not in columnar dump {dump['snapshot']}")
+        with ColumnarFile(columnar_path(old["snapshot"], old["tables"][table_name]["file"])) as old_file, \
+                ColumnarFile(columnar_path(new["snapshot"], new["tables"][table_name]["file"])) as new_file:
+            if key not in old_file.columns or key not in new_file.columns:
+                raise ValueError(f"Column {key} is not in table {table_name}")
+            diff = diff_columnar(old_file, new_file, key)
+    return {"table": table_name, "old": old["snapshot"], "new": new["snapshot"], **diff}
@@ -0,0 +1,323 @@
+"""
+Compact columnar table files, used for archived snapshots and bulk exports.
+
+One file holds one table. It is laid out like a small Parquet file: rows
+are split into row groups of COLUMNAR_ROW_GROUP rows, each group stores its
+column blocks one after another, and a JSON footer describes them all.
+
+    MAGIC | group 1 blocks | group 2 blocks | ... | footer JSON | footer length (u64) | MAGIC
+
+Integers and floats are stored as packed int64/float64 arrays. Text and
+blobs are stored as an int64 offsets array plus the concatenated bytes.
+NULLs are kept in a one-byte-per-row mask, written only when a column has
+NULLs in that group. Each block is compressed on its own (zstd if
+installed, else gzip). Writers only hold one row group in memory and never
+seek, so a file can be streamed out as it is written.
+
+Files are read through mmap. Only uncompressed files (compression "none")
+return numeric columns as zero-copy views of the map; the compressed
+default decompresses each block it reads.
+"""
+import gzip
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+from itertools import islice
+from typing import Iterable, Iterator, List, Optional, Sequence
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MAGIC = b"WCOL0001"
+FORMAT_VERSION = 2
+FOOTER_LENGTH = struct.Struct("<Q")
+ALIGNMENT = 8
+
+COMPRESSIONS = ("none", "gzip", "zstd")
+DEFAULT_COMPRESSION = os.getenv("SNAPSHOT_COMPRESSION", "zstd" if zstandard else "gzip")
+COMPRESSION_LEVEL = int(os.getenv("SNAPSHOT_COMPRESSION_LEVEL", 6))
+# Rows buffered per row group while writing
+COLUMNAR_ROW_GROUP = int(os.getenv("COLUMNAR_ROW_GROUP", 16384))
+
+# array typecodes for the fixed-width kinds
+TYPECODES = {"int": "q", "float": "d"}
+
+
+def compress(data: bytes, method: str) -> bytes:
+    if method == "none":
+        return data
+    if method == "gzip":
+        return gzip.compress(data, compresslevel=COMPRESSION_LEVEL)
+    if method == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstd compression needs the zstandard package")
+        return zstandard.ZstdCompressor(level=COMPRESSION_LEVEL).compress(data)
+    raise ValueError(f"Unknown compression {method}")
+
+
+def decompress(data, method: str) -> bytes:
+    if method == "gzip":
+        return gzip.decompress(data)
+    if method == "zstd":
+        if zstandard is None:
+            raise RuntimeError("Reading zstd snapshots needs the zstandard package")
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise ValueError(f"Unknown compression {method}")
+
+
+def infer_kind(values: Sequence) -> str:
+    """
+    Pick the narrowest encoding that holds every non-NULL value. SQLite is
+    dynamically typed, so a column that mixes types is stored as text.
+    """
+    kind = None
+    for value in values:
+        if value is None:
+            continue
+        if isinstance(value, int):
+            current = "int" if -2 ** 63 <= value < 2 ** 63 else "text"
+        elif isinstance(value, float):
+            current = "float"
+        elif isinstance(value, (bytes, bytearray, memoryview)):
+            current = "blob"
+        else:
+            current = "text"
+        if kind is None or kind == current:
+            kind = current
+        elif {kind, current} == {"int", "float"}:
+            kind = "float"
+        else:
+            return "text"
+    return kind or "int"
+
+
+def encode_column(values: Sequence, kind: str) -> dict:
+    """
+    Return the raw blocks of one column, keyed by role.
+    """
+    blocks = {}
+    if any(value is None for value in values):
+        blocks["nulls"] = bytes(1 if value is None else 0 for value in values)
+    if kind in TYPECODES:
+        zero = 0 if kind == "int" else 0.0
+        blocks["values"] = array(TYPECODES[kind], (zero if value is None else value for value in values)).tobytes()
+        return blocks
+    offsets = array("q", [0])
+    data = bytearray()
+    for value in values:
+        if value is not None:
+            data += bytes(value) if kind == "blob" else str(value).encode()
+        offsets.append(len(data))
+    blocks["offsets"] = offsets.tobytes()
+    blocks["data"] = bytes(data)
+    return blocks
+
+
+def stream_columnar(names: List[str], rows: Iterable[Sequence], compression: Optional[str] = None, meta: Optional[dict] = None,
+                    footer: Optional[dict] = None, row_group_size: Optional[int] = None) -> Iterator[bytes]:
+    """
+    Encode rows (tuples in `names` order) as a columnar file, yielding it in
+    chunks of at most one row group. If a footer dict is passed it is filled
+    in as the file is written.
+    """
+    compression = compression or DEFAULT_COMPRESSION
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unknown compression {compression}")
+    row_group_size = row_group_size or COLUMNAR_ROW_GROUP
+    footer = footer if footer is not None else {}
+    footer.update({
+        "version": FORMAT_VERSION,
+        "rows": 0,
+        "compression": compression,
+        "byteorder": sys.byteorder,
+        "columns": [{"name": name} for name in names],
+        "row_groups": [],
+        "meta": meta or {},
+    })
+    rows = iter(rows)
+    offset = len(MAGIC)
+    yield MAGIC
+    while True:
+        batch = list(islice(rows, row_group_size))
+        if not batch:
+            break
+        chunk = bytearray()
+        group = {"rows": len(batch), "columns": []}
+        for values in zip(*batch):
+            kind = infer_kind(values)
+            column = {"kind": kind, "blocks": {}}
+            for role, raw in encode_column(values, kind).items():
+                stored = compress(raw, compression)
+                chunk += b"\0" * (-(offset + len(chunk)) % ALIGNMENT)
+                column["blocks"][role] = {"offset": offset + len(chunk), "length": len(stored), "raw_length": len(raw)}
+                chunk += stored
+            group["columns"].append(column)
+        del batch
+        footer["row_groups"].append(group)
+        footer["rows"] += group["rows"]
+        offset += len(chunk)
+        yield bytes(chunk)
+    encoded = json.dumps(footer, separators=(",", ":")).encode()
+    yield encoded + FOOTER_LENGTH.pack(len(encoded)) + MAGIC
+
+
+def write_columnar(path: str, names: List[str], rows: Iterable[Sequence], compression: Optional[str] = None, meta: Optional[dict] = None) -> dict:
+    """
+    Write rows (tuples in `names` order) to a columnar file at path and
+    return its footer.
+    """
+    footer = {}
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        for chunk in stream_columnar(names, rows, compression, meta, footer):
+            f.write(chunk)
+    os.replace(tmp, path)
+    footer["bytes"] = os.path.getsize(path)
+    return footer
+
+
+class ColumnarFile:
+    """
+    Read a file written by write_columnar. Use it as a context manager; views
+    returned by column() must be released before the file is closed.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        size = len(self._map)
+        if self._map[:len(MAGIC)] != MAGIC or self._map[size - len(MAGIC):] != MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a columnar snapshot file")
+        end = size - len(MAGIC) - FOOTER_LENGTH.size
+        (length,) = FOOTER_LENGTH.unpack_from(self._map, end)
+        self.footer = json.loads(self._map[end - length:end])
+        if self.footer.get("version") != FORMAT_VERSION or "row_groups" not in self.footer:
+            self.close()
+            raise ValueError(f"{path} has an unsupported columnar format version {self.footer.get('version')}")
+        self.rows = self.footer["rows"]
+        self.compression = self.footer["compression"]
+        self.names = [column["name"] for column in self.footer["columns"]]
+        self.columns = {name: index for index, name in enumerate(self.names)}
+        self.row_groups = self.footer["row_groups"]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        try:
+            self._map.close()
+        except BufferError:
+            # A caller still holds a view; the map is released with it
+            pass
+        self._file.close()
+
+    def _block(self, block: dict):
+        view = memoryview(self._map)[block["offset"]:block["offset"] + block["length"]]
+        if self.compression == "none":
+            return view
+        try:
+            return decompress(view, self.compression)
+        finally:
+            view.release()
+
+    def _bytes(self, block: dict) -> bytes:
+        data = self._block(block)
+        if isinstance(data, memoryview):
+            try:
+                return data.tobytes()
+            finally:
+                data.release()
+        return data
+
+    def _decode(self, group: dict, name: str) -> Sequence:
+        """
+        Values of one column in one row group, NULLs included. Numeric
+        columns of uncompressed files come back as views onto the map.
+        """
+        column = group["columns"][self.columns[name]]
+        kind = column["kind"]
+        rows = group["rows"]
+        nulls_block = column["blocks"].get("nulls")
+        nulls = self._bytes(nulls_block) if nulls_block else None
+        if kind in TYPECODES:
+            values = self._block(column["blocks"]["values"])
+            if self.footer["byteorder"] != sys.byteorder:
+                swapped = array(TYPECODES[kind], bytes(values))
+                swapped.byteswap()
+                if isinstance(values, memoryview):
+                    values.release()
+                values = swapped
+            elif isinstance(values, memoryview):
+                values = values.cast(TYPECODES[kind])
+            else:
+                values = array(TYPECODES[kind], values)
+            if nulls is None:
+                return values
+            decoded = [None if null else value for value, null in zip(values, nulls)]
+            if isinstance(values, memoryview):
+                values.release()
+            return decoded
+
+        offsets = array("q", self._bytes(column["blocks"]["offsets"]))
+        if self.footer["byteorder"] != sys.byteorder:
+            offsets.byteswap()
+        data = self._bytes(column["blocks"]["data"])
+        nulls = nulls or bytes(rows)
+        if kind == "blob":
+            return [None if nulls[i] else data[offsets[i]:offsets[i + 1]] for i in range(rows)]
+        return [None if nulls[i] else data[offsets[i]:offsets[i + 1]].decode() for i in range(rows)]
+
+    def column(self, name: str) -> Sequence:
+        """
+        Every value of one column. A single-group uncompressed file returns
+        numeric columns as a zero-copy view; otherwise the groups are joined
+        into a list.
+        """
+        if len(self.row_groups) == 1:
+            return self._decode(self.row_groups[0], name)
+        values = []
+        for group in self.row_groups:
+            part = self._decode(group, name)
+            values.extend(part)
+            if isinstance(part, memoryview):
+                part.release()
+        return values
+
+    def iter_rows(self, names: Optional[List[str]] = None):
+        # One row group is decoded at a time
+        names = names or self.names
+        for group in self.row_groups:
+            columns = [self._decode(group, name) for name in names]
+            try:
+                yield from zip(*columns)
+            finally:
+                for values in columns:
+                    if isinstance(values, memoryview):
+                        values.release()
+
+
+def diff_columnar(old: ColumnarFile, new: ColumnarFile, key: str) -> dict:
+    """
+    Compare two snapshots of a table by its key column. Returns the keys that
+    were added, removed or changed between them.
+    """
+    names = [name for name in new.names if name in old.columns]
+    old_rows = {row[0]: row for row in old.iter_rows([key] + names)}
+    added, changed = [], []
+    for row in new.iter_rows([key] + names):
+        previous = old_rows.pop(row[0], None)
+        if previous is None:
+            added.append(row[0])
+        elif previous != row:
+            changed.append(row[0])
+    return {"added": added, "removed": list(old_rows), "changed": changed}
@@ -0,0 +1,30 @@
+from fastapi import APIRouter, FastAPI, Request
+from fastapi.staticfiles import StaticFiles
+from fastapi.templating import Jinja2Templates
+
+
+def desk_context(request: Request) -> dict:
+    """
+    Expose the prefix a desk is mounted under as {{ root }}, so links and
+    form actions work both standalone and inside service.py.
+    """
+    return {"root": request.scope.get("root_path", "")}
+
+
+templates = Jinja2Templates(directory="templates", context_processors=[desk_context])
+
+
+def desk_url(request: Request, path: str) -> str:
+    return request.scope.get("root_path", "") + path
+
+
+def desk_app(router: APIRouter, static: bool = True, **kwargs) -> FastAPI:
+    """
+    Build a FastAPI app serving one desk router. Standalone apps mount
+    /static themselves; service.py mounts it once for all desks.
+    """
+    app = FastAPI(**kwargs)
+    if static:
+        app.mount("/static", StaticFiles(directory="static"), name="static")
+    app.include_router(router)
+    return app
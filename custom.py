@@ -1,75 +1,70 @@
-from fastapi import FastAPI, Depends, Request, Form, HTTPException, Query
+from fastapi import APIRouter, Depends, Request, Form, HTTPException, Query
+from fastapi.encoders import jsonable_encoder
 from fastapi.responses import RedirectResponse, HTMLResponse, JSONResponse
-from fastapi.templating import Jinja2Templates
-from fastapi.staticfiles import StaticFiles
 from sqlalchemy.orm import Session
 from sqlalchemy.exc import IntegrityError
-from database import SessionLocal, Master, ProcessedMaster, User
+from database import get_db, Master, BookingInfo, Group, GroupInfo, ProcessedMaster, ProcessedMasterArchive, CustomsBatch, CustomsQueue, User, MASTER_COLUMNS, fetch_master, prefetch_masters, processed_count as get_processed_count
+from auth import get_current_user, issue_session, clear_session
+from common import templates, desk_url, desk_app
+from events import publish
 import os
 from datetime import datetime
+from typing import List, Optional
 
-app = FastAPI()
+router = APIRouter()
 
-app.mount("/static", StaticFiles(directory="static"), name="static")
-templates = Jinja2Templates(directory="templates")
-
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
-@app.get("/")
+@router.get("/")
 def login_form(request: Request):
     return templates.TemplateResponse("login.html", {"request": request})
 
-@app.post("/login/")
-async def login(request: Request, username: str = Form(...), password: str = Form(...), db: Session = Depends(get_db)):
+@router.post("/login/")
+def login(request: Request, username: str = Form(...), password: str = Form(...), db: Session = Depends(get_db)):
     user = db.query(User).filter(User.username == username).first()
     if user and user.password == password:
-        response = RedirectResponse(url="/master-form/", status_code=303)
-        response.set_cookie(key="username", value=username)
+        response = RedirectResponse(url=desk_url(request, "/master-form/"), status_code=303)
+        issue_session(response, user)
         return response
     return templates.TemplateResponse("login.html", {"request": request, "error": "Invalid username or password"})
 
-@app.get("/logout/")
+@router.get("/logout/")
 async def logout(request: Request):
-    response = RedirectResponse(url="/", status_code=303)
-    response.delete_cookie("username")
+    response = RedirectResponse(url=desk_url(request, "/"), status_code=303)
+    clear_session(response)
     return response
 
-def get_current_user(request: Request, db: Session = Depends(get_db)):
-    username = request.cookies.get("username")
-    if not username:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    user = db.query(User).filter(User.username == username).first()
-    if not user:
-        raise HTTPException(status_code=401, detail="User not found")
-    return user
-
-@app.get("/master-form/")
+@router.get("/master-form/")
 def get_master_form(request: Request, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
     if current_user.designation.lower() in ["admin", "custom"]:
-        processed_count = db.query(ProcessedMaster).filter(ProcessedMaster.processed_by == current_user.username).count()
-        return templates.TemplateResponse("master_.html", {"request": request, "processedCount": processed_count})
+        processed_count = get_processed_count(db, current_user.username)
+        return templates.TemplateResponse("master_.html", {"request": request, "processedCount": processed_count, "queue": queue_status(db, current_user.username)})
     raise HTTPException(status_code=403, detail="Not authorized")
 
-@app.get("/master/")
+@router.get("/master/")
 def get_master_by_its(request: Request, its: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    master = db.query(Master).filter(Master.ITS == its).first()
+    master = fetch_master(db, its)
     if not master:
         return templates.TemplateResponse("master_.html", {"request": request, "error": "Master not found"})
-    processed_count = db.query(ProcessedMaster).filter(ProcessedMaster.processed_by == current_user.username).count()
+    processed_count = get_processed_count(db, current_user.username)
     return templates.TemplateResponse("master_.html", {"request": request, "master": master, "processedCount": processed_count})
 
-@app.get("/master/check-duplicate")
+@router.get("/master/check-duplicate")
 def check_duplicate(its: int, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    is_duplicate = db.query(ProcessedMaster).filter(ProcessedMaster.ITS == its, ProcessedMaster.processed_by == current_user.username).count() > 0
+    is_duplicate = processed_by(db, its) == current_user.username
     return JSONResponse(content={'isDuplicate': is_duplicate})
 
-@app.post("/master/update", response_class=HTMLResponse)
-async def update_master(
+
+# Records are queued per officer in processed_master; every
+# CUSTOMS_BATCH_SIZE records the batch is closed, archived and printed
+CUSTOMS_BATCH_SIZE = int(os.getenv("CUSTOMS_BATCH_SIZE", 10))
+
+
+def processed_by(db: Session, its: int):
+    # Who has the ITS in an open batch (ITS is unique there), if anyone
+    return db.query(ProcessedMaster.processed_by).filter(ProcessedMaster.ITS == its).scalar()
+
+
+@router.post("/master/update", response_class=HTMLResponse)
+def update_master(
     request: Request,
     its: int = Form(...),
     first_name: str = Form(...),
@@ -81,15 +76,16 @@ async def update_master(
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user)
 ):
-    is_duplicate = db.query(ProcessedMaster).filter(ProcessedMaster.ITS == its, ProcessedMaster.processed_by == current_user.username).count() > 0
-    if is_duplicate:
-        processed_count = db.query(ProcessedMaster).filter(ProcessedMaster.processed_by == current_user.username).count()
-        return templates.TemplateResponse("master_.html", {"request": request, "error": "Record already processed", "processedCount": processed_count})
+    owner = processed_by(db, its)
+    if owner is not None:
+        error = "Record already processed" if owner == current_user.username else "Record already exists"
+        return templates.TemplateResponse("master_.html", {"request": request, "error": error, "processedCount": get_processed_count(db, current_user.username)})
 
-    master = db.query(Master).filter(Master.ITS == its).first()
+    master = fetch_master(db, its)
     if not master:
         return templates.TemplateResponse("master_.html", {"request": request, "error": "Master not found"})
 
+    # The corrections and the processed record commit together
     try:
         master.first_name = first_name
         master.middle_name = middle_name
@@ -98,9 +94,7 @@ async def update_master(
         master.passport_Expiry = datetime.strptime(passport_Expiry, "%Y-%m-%d").date()
         master.Visa_No = Visa_No
 
-        db.commit()
-
-        processed_master = ProcessedMaster(
+        db.add(ProcessedMaster(
             ITS=master.ITS,
             first_name=master.first_name,
             middle_name=master.middle_name,
@@ -114,69 +108,181 @@ async def update_master(
             arrived=master.arrived,
             timestamp=master.timestamp,
             processed_by=current_user.username
-        )
-        db.add(processed_master)
+        ))
         db.commit()
-
-        processed_count = db.query(ProcessedMaster).filter(ProcessedMaster.processed_by == current_user.username).count()
-
-        if processed_count >= 10:
-            return await print_processed_its(request, current_user, db)  # Pass db to print_processed_its
-
     except IntegrityError:
         db.rollback()
         return templates.TemplateResponse("master_.html", {"request": request, "error": "Record already exists"})
 
-    processed_count = db.query(ProcessedMaster).filter(ProcessedMaster.processed_by == current_user.username).count()
-    return templates.TemplateResponse("master_.html", {"request": request, "processedCount": processed_count})
+    processed_count = get_processed_count(db, current_user.username)
+    publish("customs", ITS=its, processed_by=current_user.username, processed_count=processed_count)
+
+    if processed_count >= CUSTOMS_BATCH_SIZE:
+        return print_processed_its(request, current_user, db)
+    return templates.TemplateResponse("master_.html", {"request": request, "processedCount": processed_count, "queue": queue_status(db, current_user.username)})
 
-@app.get("/master/info/", response_class=HTMLResponse)
-async def get_master_info(request: Request, its: int = Query(...), db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    master = db.query(Master).filter(Master.ITS == its).first()
+@router.get("/master/info/", response_class=HTMLResponse)
+def get_master_info(request: Request, its: int = Query(...), db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+    master = fetch_master(db, its)
     if not master:
         return templates.TemplateResponse("master_.html", {"request": request, "error": "Master not found"})
-    processed_count = db.query(ProcessedMaster).filter(ProcessedMaster.processed_by == current_user.username).count()
+    processed_count = get_processed_count(db, current_user.username)
     return templates.TemplateResponse("master_.html", {"request": request, "master": master, "processedCount": processed_count})
 
-@app.get("/print-processed-its/")
-async def print_processed_its(request: Request, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    processed_entries = db.query(ProcessedMaster).filter(ProcessedMaster.processed_by == current_user.username).all()
-
-    response_content = """
-    <html>
-        <body>
-            <h2>Processed ITS Entries</h2>
-            <table border="1">
-                <thead>
-                    <tr>
-                        <th>ITS</th>
-                        <th>Name</th>
-                        <th>Passport Number</th>
-                        <th>Visa Number</th>
-                    </tr>
-                </thead>
-                <tbody>
+
+def render_batch(request: Request, db: Session, batch: CustomsBatch):
+    entries = (
+        db.query(ProcessedMasterArchive)
+        .filter(ProcessedMasterArchive.batch_id == batch.id)
+        .order_by(ProcessedMasterArchive.id)
+        .all()
+    )
+    return templates.TemplateResponse("customs_batch.html", {"request": request, "batch": batch, "entries": entries})
+
+
+# Close the officer's open batch and print it
+@router.get("/print-processed-its/", response_class=HTMLResponse)
+def print_processed_its(request: Request, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    batch = CustomsBatch.close(db, current_user.username)
+    if batch is None:
+        return templates.TemplateResponse("customs_batch.html", {"request": request, "batch": None, "entries": []})
+    return render_batch(request, db, batch)
+
+
+@router.get("/batches/", response_class=HTMLResponse)
+def list_batches(request: Request, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    batches = (
+        db.query(CustomsBatch)
+        .filter(CustomsBatch.processed_by == current_user.username)
+        .order_by(CustomsBatch.id.desc())
+        .limit(100)
+        .all()
+    )
+    return templates.TemplateResponse("customs_batches.html", {"request": request, "batches": batches})
+
+
+# Reprint an archived batch
+@router.get("/batches/{batch_id}/", response_class=HTMLResponse)
+def get_batch(request: Request, batch_id: int, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    batch = db.get(CustomsBatch, batch_id)
+    if batch is None or (batch.processed_by != current_user.username and current_user.designation.lower() != "admin"):
+        raise HTTPException(status_code=404, detail="Batch not found")
+    return render_batch(request, db, batch)
+
+
+# Queue mode: the officer picks a bus or group and steps through it. Each
+# step sends the next CUSTOMS_PREFETCH records along with the current one,
+# so the officer can ready those passports while this one is processed.
+# They are sent to the browser rather than cached on the server, because
+# the next request may be served by another worker. The queue itself is a
+# CustomsQueue row, so it is shared by every worker.
+CUSTOMS_PREFETCH = int(os.getenv("CUSTOMS_PREFETCH", 10))
+
+
+def queue_status(db: Session, username: str) -> Optional[dict]:
+    queue = db.get(CustomsQueue, username)
+    return queue.status() if queue else None
+
+
+def queue_members(db: Session, source: str, number: int) -> List[int]:
     """
-    for entry in processed_entries:
-        response_content += f"""
-        <tr>
-            <td>{entry.ITS}</td>
-            <td>{entry.first_name} {entry.last_name}</td>
-            <td>{entry.passport_No}</td>
-            <td>{entry.Visa_No}</td>
-        </tr>
-        """
-    response_content += """
-                </tbody>
-            </table>
-        </body>
-    </html>
+    ITS numbers booked on bus `number` (by seat) or in group `number`
+    (leader first), leaving out records already in an open batch.
     """
+    if source == "bus":
+        its_list = [its for its, in (
+            db.query(BookingInfo.ITS)
+            .filter(BookingInfo.bus_number == number)
+            .order_by(BookingInfo.seat_number, BookingInfo.ITS)
+        )]
+    else:
+        group = db.get(Group, number)
+        if group is None:
+            return []
+        its_list = [group.leader_ITS] + [its for its, in (
+            db.query(GroupInfo.ITS).filter(GroupInfo.group_ID == group.ID).order_by(GroupInfo.ID)
+        )]
+    its_list = [its for its in dict.fromkeys(its_list) if its is not None]
+    processed = {its for its, in db.query(ProcessedMaster.ITS).filter(ProcessedMaster.ITS.in_(its_list))} if its_list else set()
+    return [its for its in its_list if its not in processed]
+
+
+def queue_masters(db: Session, its_list: List[int]) -> List[Master]:
+    # One query for the whole window, in queue order
+    prefetch_masters(db, its_list)
+    masters = [fetch_master(db, its) for its in its_list]
+    return [master for master in masters if master is not None]
+
+
+@router.post("/queue/")
+def start_queue(
+    request: Request,
+    source: str = Form(...),
+    number: int = Form(...),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    if source not in ("bus", "group"):
+        raise HTTPException(status_code=400, detail="Queue source must be bus or group")
+    its_list = queue_members(db, source, number)
+    if not its_list:
+        return templates.TemplateResponse("master_.html", {
+            "request": request,
+            "error": f"Nothing left to process for {source} {number}",
+            "processedCount": get_processed_count(db, current_user.username),
+        })
+    CustomsQueue.start(db, current_user.username, f"{source} {number}", its_list)
+    return RedirectResponse(url=desk_url(request, "/queue/next/"), status_code=303)
+
+
+@router.get("/queue/next/", response_class=HTMLResponse)
+def next_in_queue(request: Request, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    processed_count = get_processed_count(db, current_user.username)
+    master = None
+    while master is None:
+        its = CustomsQueue.advance(db, current_user.username)
+        if its is None:
+            break
+        # Someone may have processed it since the queue was built
+        if processed_by(db, its) is None:
+            master = fetch_master(db, its)
+    queue = db.get(CustomsQueue, current_user.username)
+    if queue is None:
+        return templates.TemplateResponse("master_.html", {"request": request, "error": "No queue selected", "processedCount": processed_count})
+    if master is None:
+        source = queue.source
+        CustomsQueue.clear(db, current_user.username)
+        return templates.TemplateResponse("master_.html", {"request": request, "error": f"Queue for {source} finished", "processedCount": processed_count})
+
+    return templates.TemplateResponse("master_.html", {
+        "request": request,
+        "master": master,
+        "processedCount": processed_count,
+        "queue": queue.status(),
+        "upcoming": queue_masters(db, queue.upcoming(db, CUSTOMS_PREFETCH)),
+    })
+
+
+# The next records as one JSON payload, for clients that keep their own copy
+@router.get("/queue/upcoming/")
+def upcoming_in_queue(count: int = Query(CUSTOMS_PREFETCH, ge=1, le=100), current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    queue = db.get(CustomsQueue, current_user.username)
+    if queue is None:
+        raise HTTPException(status_code=404, detail="No queue selected")
+    masters = queue_masters(db, queue.upcoming(db, count))
+    return JSONResponse(content=jsonable_encoder({
+        "queue": queue.status(),
+        "masters": [{key: getattr(master, key) for key in MASTER_COLUMNS} for master in masters],
+    }))
+
+
+@router.get("/queue/clear/")
+def clear_queue(request: Request, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    CustomsQueue.clear(db, current_user.username)
+    return RedirectResponse(url=desk_url(request, "/master-form/"), status_code=303)
 
-    db.query(ProcessedMaster).filter(ProcessedMaster.processed_by == current_user.username).delete()
-    db.commit()
-    return HTMLResponse(content=response_content)
 
+app = desk_app(router)
 
 if __name__ == "__main__":
     import uvicorn
@@ -1,8 +1,14 @@
 import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
 from sqlalchemy.orm import Session
-from sqlalchemy import create_engine, Column, Integer, String, Date, Boolean, ForeignKey, DateTime
+from sqlalchemy import create_engine, Column, Integer, String, Date, Boolean, ForeignKey, DateTime, Index, bindparam, event, literal, select, update, text
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy.orm import relationship, sessionmaker, make_transient_to_detached
+from sqlalchemy.orm.util import identity_key
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from dotenv import load_dotenv
 from sqlalchemy.sql import func
 # Load environment variables
@@ -14,12 +20,67 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     raise ValueError("DATABASE_URL environment variable is not set.")
 
+# SQLite performance profile, applied to every new connection. WAL lets the
+# desks read while another process writes, busy_timeout makes writers queue
+# instead of failing with "database is locked".
+SQLITE_PRAGMAS = {
+    "journal_mode": os.getenv("SQLITE_JOURNAL_MODE", "WAL"),
+    "synchronous": os.getenv("SQLITE_SYNCHRONOUS", "NORMAL"),
+    "cache_size": int(os.getenv("SQLITE_CACHE_SIZE", -64000)),  # negative means KiB
+    "mmap_size": int(os.getenv("SQLITE_MMAP_SIZE", 256 * 1024 * 1024)),
+    "busy_timeout": int(os.getenv("SQLITE_BUSY_TIMEOUT", 15000)),  # milliseconds
+    "temp_store": os.getenv("SQLITE_TEMP_STORE", "MEMORY"),
+}
+
+# Connection pool per process. Every desk process keeps its own pool, so
+# keep these small when many processes share one SQLite file.
+POOL_OPTIONS = {
+    "pool_size": int(os.getenv("DB_POOL_SIZE", 5)),
+    "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", 10)),
+    "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", 30)),
+    "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", 3600)),
+}
+
+
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {name} = {value}")
+    cursor.close()
+
+
+def configure_engine(engine):
+    if engine.dialect.name == "sqlite":
+        event.listen(engine, "connect", apply_sqlite_pragmas)
+    return engine
+
+
+def engine_options(url: str) -> dict:
+    if url.startswith("sqlite") and ":memory:" not in url:
+        return POOL_OPTIONS
+    return {}
+
+
 # Create the SQLAlchemy engine
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+engine = configure_engine(create_engine(
+    DATABASE_URL,
+    connect_args={"check_same_thread": False, "timeout": SQLITE_PRAGMAS["busy_timeout"] / 1000},
+    **engine_options(DATABASE_URL),
+))
 
 # Create a configured "Session" class
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Async engine for handlers that run on the event loop. Derived from
+# DATABASE_URL unless ASYNC_DATABASE_URL is set (sqlite -> aiosqlite).
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL") or DATABASE_URL.replace("sqlite://", "sqlite+aiosqlite://", 1)
+async_engine = create_async_engine(ASYNC_DATABASE_URL, **engine_options(ASYNC_DATABASE_URL))
+configure_engine(async_engine.sync_engine)
+
+# expire_on_commit=False: objects stay readable after commit without an
+# implicit (blocking) refresh
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
 # Create a base class for the models
 Base = declarative_base()
 
@@ -39,6 +100,12 @@ class Master(Base):
     arrived = Column(Boolean, default=False)
     timestamp = Column(DateTime, default=func.now())
 
+    # Arrived masters by time ("who arrived since ..."); also serves plain
+    # arrived = 1 lookups
+    __table_args__ = (
+        Index("ix_master_arrived_timestamp", "arrived", "timestamp"),
+    )
+
 # Define the Group model with a composite primary key
 # Define the Group model with a composite primary key
 class Group(Base):
@@ -56,7 +123,7 @@ class GroupInfo(Base):
     ITS = Column(Integer, ForeignKey('master.ITS'), index=True)
 
 # Define the Booking_Info model with a composite primary key
-from typing import Optional
+from typing import List, Optional
 
 class BookingInfo(Base):
     __tablename__ = "booking_info"
@@ -75,9 +142,13 @@ class BookingInfo(Base):
         """
         try:
             # Check if the ITS exists in the Master table
-            master_record = db_session.query(Master).filter(Master.ITS == its).first()
+            master_record = fetch_master(db_session, its)
             if not master_record:
                 return None  # Return None if ITS doesn't exist
+
+            # Claim the seat so no other desk can hand it out
+            if BusSeat.claim(db_session, bus_number, its, seat_number) is None:
+                return None
             
             # Update the BookingInfo table
             booking_info = BookingInfo(
@@ -97,6 +168,140 @@ class BookingInfo(Base):
             db_session.rollback()
             return None
 
+class BusSeat(Base):
+    """
+    One row per seat of a bus; ITS is NULL while the seat is free. Seats are
+    claimed with a single conditional UPDATE, so two desks can never get
+    the same seat, and the partial index makes finding a free seat O(log n).
+    """
+    __tablename__ = "bus_seat"
+    bus_number = Column(Integer, primary_key=True)
+    seat_number = Column(Integer, primary_key=True)
+    ITS = Column(Integer, ForeignKey('master.ITS'), nullable=True, index=True)
+
+    __table_args__ = (
+        Index("ix_bus_seat_free", "bus_number", "seat_number", sqlite_where=text("ITS IS NULL")),
+    )
+
+    @staticmethod
+    def ensure_seats(db_session: Session, bus_number: int):
+        """
+        Create the seat rows of a bus the first time they are needed, marking
+        seats already handed out in booking_info as taken.
+        """
+        if db_session.query(BusSeat.seat_number).filter(BusSeat.bus_number == bus_number).first():
+            return
+        bus = db_session.query(Bus).filter(Bus.bus_number == bus_number).first()
+        if not bus:
+            return
+        booked = dict(
+            db_session.query(BookingInfo.seat_number, BookingInfo.ITS)
+            .filter(BookingInfo.bus_number == bus_number, BookingInfo.seat_number.isnot(None))
+            .all()
+        )
+        # no_of_seats is decremented on every booking, so it holds the free seats
+        capacity = max([bus.no_of_seats + len(booked)] + list(booked))
+        if capacity <= 0:
+            return
+        db_session.execute(
+            BusSeat.__table__.insert().prefix_with("OR IGNORE"),
+            [{"bus_number": bus_number, "seat_number": seat, "ITS": booked.get(seat)} for seat in range(1, capacity + 1)],
+        )
+
+    @staticmethod
+    def claim(db_session: Session, bus_number: int, its: int, seat_number: Optional[int] = None) -> Optional[int]:
+        """
+        Atomically give its the lowest free seat of the bus, or the requested
+        seat_number. Returns the seat number, or None if nothing was free.
+        """
+        BusSeat.ensure_seats(db_session, bus_number)
+        table = BusSeat.__table__
+        if seat_number is None:
+            seat_number = (
+                select(table.c.seat_number)
+                .where(table.c.bus_number == bus_number, table.c.ITS.is_(None))
+                .order_by(table.c.seat_number)
+                .limit(1)
+                .scalar_subquery()
+            )
+        claimed = db_session.execute(
+            update(table)
+            .where(table.c.bus_number == bus_number, table.c.seat_number == seat_number, table.c.ITS.is_(None))
+            .values(ITS=its)
+            .returning(table.c.seat_number)
+        ).first()
+        return claimed[0] if claimed else None
+
+    @staticmethod
+    def pick_adjacent(free_seats: List[int], count: int) -> List[int]:
+        """
+        Choose count seats out of the sorted free_seats, keeping people
+        together: the tightest run of consecutive seats that fits everyone,
+        otherwise the longest runs first.
+        """
+        runs = []
+        for seat in free_seats:
+            if runs and seat == runs[-1][-1] + 1:
+                runs[-1].append(seat)
+            else:
+                runs.append([seat])
+        fitting = [run for run in runs if len(run) >= count]
+        if fitting:
+            return min(fitting, key=len)[:count]
+        picked = []
+        for run in sorted(runs, key=len, reverse=True):
+            picked.extend(run[:count - len(picked)])
+            if len(picked) == count:
+                break
+        return sorted(picked)
+
+    @staticmethod
+    def claim_block(db_session: Session, bus_number: int, its_list: List[int]) -> List[tuple]:
+        """
+        Seat as many of its_list as fit on the bus, adjacent where possible.
+        Returns (ITS, seat_number) pairs; call inside begin_immediate().
+        """
+        BusSeat.ensure_seats(db_session, bus_number)
+        free_seats = [
+            seat for seat, in db_session.query(BusSeat.seat_number)
+            .filter(BusSeat.bus_number == bus_number, BusSeat.ITS.is_(None))
+            .order_by(BusSeat.seat_number)
+        ]
+        seats = BusSeat.pick_adjacent(free_seats, min(len(its_list), len(free_seats)))
+        pairs = list(zip(its_list, seats))
+        if not pairs:
+            return []
+        table = BusSeat.__table__
+        result = db_session.execute(
+            update(table)
+            .where(table.c.bus_number == bus_number, table.c.seat_number == bindparam("seat"), table.c.ITS.is_(None))
+            .values(ITS=bindparam("its")),
+            [{"its": its, "seat": seat} for its, seat in pairs],
+        )
+        if result.rowcount != len(pairs):
+            raise RuntimeError(f"Seats on bus {bus_number} were taken concurrently")
+        return pairs
+
+    @staticmethod
+    def release(db_session: Session, bus_number: int, its: int):
+        db_session.execute(
+            update(BusSeat.__table__)
+            .where(BusSeat.bus_number == bus_number, BusSeat.ITS == its)
+            .values(ITS=None)
+        )
+
+
+def begin_immediate(db_session: Session):
+    """
+    Take the SQLite write lock at the start of a read-then-write transaction,
+    so concurrent desks queue on busy_timeout instead of failing to upgrade
+    their read lock halfway through.
+    """
+    connection = db_session.connection()
+    if not connection.connection.dbapi_connection.in_transaction:
+        connection.exec_driver_sql("BEGIN IMMEDIATE")
+
+
 class Transport(Base):
     __tablename__ = "transport"
     id = Column(Integer, primary_key=True, index=True)
@@ -180,10 +385,543 @@ class ProcessedMaster(Base):
     phone = Column(String, index=True)
     arrived = Column(Boolean, default=False)
     timestamp = Column(DateTime, default=func.now())
+    processed_by = Column(String, ForeignKey('users.username'), index=True)
+
+
+# Customs batches: processed_master holds each officer's open batch; when it
+# is printed the rows move to processed_master_archive under one batch id
+class CustomsBatch(Base):
+    __tablename__ = "customs_batch"
+    id = Column(Integer, primary_key=True)
+    processed_by = Column(String, ForeignKey('users.username'), index=True)
+    size = Column(Integer, nullable=False)
+    closed_at = Column(DateTime, default=func.now())
+
+    @staticmethod
+    def close(db_session: Session, username: str) -> Optional["CustomsBatch"]:
+        """
+        Move the officer's open records into a new batch, in one transaction.
+        Returns None if nothing was open.
+        """
+        begin_immediate(db_session)
+        size = read_counter(db_session, f"processed:{username}")
+        if not size:
+            db_session.rollback()
+            return None
+        batch = CustomsBatch(processed_by=username, size=size, closed_at=datetime.now())
+        db_session.add(batch)
+        db_session.flush()
+        columns = [column.key for column in ProcessedMaster.__table__.columns if column.key != "id"]
+        source = ProcessedMaster.__table__
+        db_session.execute(
+            ProcessedMasterArchive.__table__.insert().from_select(
+                ["batch_id"] + columns,
+                select(literal(batch.id), *(source.c[name] for name in columns))
+                .where(source.c.processed_by == username)
+                .order_by(source.c.id),
+            )
+        )
+        db_session.execute(source.delete().where(source.c.processed_by == username))
+        db_session.commit()
+        return batch
+
+
+class ProcessedMasterArchive(Base):
+    __tablename__ = "processed_master_archive"
+    id = Column(Integer, primary_key=True)
+    batch_id = Column(Integer, ForeignKey('customs_batch.id'), nullable=False, index=True)
+    ITS = Column(Integer, ForeignKey('master.ITS'), index=True)
+    first_name = Column(String)
+    middle_name = Column(String)
+    last_name = Column(String)
+    DOB = Column(Date)
+    passport_No = Column(String)
+    passport_Expiry = Column(Date)
+    Visa_No = Column(String)
+    Mode_of_Transport = Column(String)
+    phone = Column(String)
+    arrived = Column(Boolean, default=False)
+    timestamp = Column(DateTime)
     processed_by = Column(String, ForeignKey('users.username'))
 
 
-    
+class CustomsQueue(Base):
+    """
+    An officer's queue mode (see custom.py): the ITS numbers to process, in
+    order, in customs_queue_item. Kept in the database so every worker sees
+    the same queue, and advanced with one UPDATE so that two quick clicks
+    never get the same record.
+    """
+    __tablename__ = "customs_queue"
+    username = Column(String, ForeignKey('users.username'), primary_key=True)
+    source = Column(String, nullable=False)
+    total = Column(Integer, nullable=False)
+    position = Column(Integer, nullable=False, default=0)
+    current_ITS = Column(Integer, ForeignKey('master.ITS'))
+    started_at = Column(DateTime, default=func.now())
+
+    def status(self) -> dict:
+        return {"source": self.source, "done": self.position, "total": self.total, "current": self.current_ITS}
+
+    def upcoming(self, db_session: Session, count: int) -> List[int]:
+        return [its for its, in (
+            db_session.query(CustomsQueueItem.ITS)
+            .filter(CustomsQueueItem.username == self.username, CustomsQueueItem.position >= self.position)
+            .order_by(CustomsQueueItem.position)
+            .limit(count)
+        )]
+
+    @staticmethod
+    def start(db_session: Session, username: str, source: str, its_list: List[int]) -> "CustomsQueue":
+        """
+        Replace the officer's queue, in one transaction.
+        """
+        begin_immediate(db_session)
+        CustomsQueue.clear(db_session, username, commit=False)
+        queue = CustomsQueue(username=username, source=source, total=len(its_list), position=0, started_at=datetime.now())
+        db_session.add(queue)
+        db_session.flush()
+        db_session.execute(
+            CustomsQueueItem.__table__.insert(),
+            [{"username": username, "position": position, "ITS": its} for position, its in enumerate(its_list)],
+        )
+        db_session.commit()
+        return queue
+
+    @staticmethod
+    def advance(db_session: Session, username: str) -> Optional[int]:
+        """
+        Claim the next ITS of the officer's queue and make it current.
+        Returns None when the queue is missing or finished.
+        """
+        item = select(CustomsQueueItem.ITS).where(
+            CustomsQueueItem.username == CustomsQueue.username,
+            CustomsQueueItem.position == CustomsQueue.position,
+        ).scalar_subquery()
+        # SET reads the row as it was before the update, so the subquery
+        # picks the item at the old position
+        its = db_session.execute(
+            update(CustomsQueue)
+            .where(CustomsQueue.username == username, CustomsQueue.position < CustomsQueue.total)
+            .values(position=CustomsQueue.position + 1, current_ITS=item)
+            .returning(CustomsQueue.current_ITS)
+            .execution_options(synchronize_session=False)
+        ).scalar()
+        db_session.commit()
+        return its
+
+    @staticmethod
+    def clear(db_session: Session, username: str, commit: bool = True):
+        db_session.execute(CustomsQueueItem.__table__.delete().where(CustomsQueueItem.username == username))
+        db_session.execute(CustomsQueue.__table__.delete().where(CustomsQueue.username == username))
+        if commit:
+            db_session.commit()
+
+
+class CustomsQueueItem(Base):
+    __tablename__ = "customs_queue_item"
+    username = Column(String, ForeignKey('customs_queue.username'), primary_key=True)
+    position = Column(Integer, primary_key=True)
+    ITS = Column(Integer, ForeignKey('master.ITS'), nullable=False)
+
+
+class ArrivalEvent(Base):
+    """
+    One row per arrived master, written by triggers on master (see
+    ARRIVAL_TRIGGERS) when arrived turns true and removed when it turns
+    false again. master.timestamp changes with other edits; arrived_at
+    doesn't. Ids grow in arrival order, so clients page with ?after=<id>.
+    """
+    __tablename__ = "arrival_event"
+    id = Column(Integer, primary_key=True)
+    ITS = Column(Integer, ForeignKey('master.ITS'), nullable=False, index=True)
+    arrived_at = Column(DateTime, nullable=False, index=True)
+
+
+# Materialized counters, kept up to date by SQLite triggers in the same
+# transaction as the write. Names: "masters", "processed", "arrived",
+# "processed:<username>", "bus_booked:<bus_number>".
+class Counter(Base):
+    __tablename__ = "counters"
+    name = Column(String, primary_key=True)
+    value = Column(Integer, nullable=False, default=0)
+
+
+def _bump(name_sql: str, delta_sql: str) -> str:
+    return (
+        f"INSERT INTO counters (name, value) VALUES ({name_sql}, {delta_sql}) "
+        f"ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;"
+    )
+
+
+# Each group: LIKE pattern of its counter names, statement recomputing it,
+# and the triggers that maintain it afterwards
+COUNTER_TRIGGERS = [
+    ("masters", "SELECT 'masters', count(*) FROM master", {
+        "counters_masters_insert": f"""
+            AFTER INSERT ON master
+            BEGIN {_bump("'masters'", "1")} END""",
+        "counters_masters_delete": f"""
+            AFTER DELETE ON master
+            BEGIN {_bump("'masters'", "-1")} END""",
+    }),
+    ("processed", "SELECT 'processed', count(*) FROM processed_master", {
+        "counters_processed_total_insert": f"""
+            AFTER INSERT ON processed_master
+            BEGIN {_bump("'processed'", "1")} END""",
+        "counters_processed_total_delete": f"""
+            AFTER DELETE ON processed_master
+            BEGIN {_bump("'processed'", "-1")} END""",
+    }),
+    ("arrived", "SELECT 'arrived', count(*) FROM master WHERE arrived = 1", {
+        "counters_arrived_insert": f"""
+            AFTER INSERT ON master WHEN NEW.arrived IS 1
+            BEGIN {_bump("'arrived'", "1")} END""",
+        "counters_arrived_update": f"""
+            AFTER UPDATE OF arrived ON master WHEN (NEW.arrived IS 1) != (OLD.arrived IS 1)
+            BEGIN {_bump("'arrived'", "(NEW.arrived IS 1) - (OLD.arrived IS 1)")} END""",
+        "counters_arrived_delete": f"""
+            AFTER DELETE ON master WHEN OLD.arrived IS 1
+            BEGIN {_bump("'arrived'", "-1")} END""",
+    }),
+    ("processed:%", "SELECT 'processed:' || processed_by, count(*) FROM processed_master WHERE processed_by IS NOT NULL GROUP BY processed_by", {
+        "counters_processed_insert": f"""
+            AFTER INSERT ON processed_master WHEN NEW.processed_by IS NOT NULL
+            BEGIN {_bump("'processed:' || NEW.processed_by", "1")} END""",
+        "counters_processed_update": f"""
+            AFTER UPDATE OF processed_by ON processed_master WHEN NEW.processed_by IS NOT OLD.processed_by
+            BEGIN
+                {_bump("'processed:' || OLD.processed_by", "-(OLD.processed_by IS NOT NULL)")}
+                {_bump("'processed:' || NEW.processed_by", "(NEW.processed_by IS NOT NULL)")}
+            END""",
+        "counters_processed_delete": f"""
+            AFTER DELETE ON processed_master WHEN OLD.processed_by IS NOT NULL
+            BEGIN {_bump("'processed:' || OLD.processed_by", "-1")} END""",
+    }),
+    ("bus_booked:%", "SELECT 'bus_booked:' || bus_number, count(*) FROM booking_info WHERE bus_number IS NOT NULL GROUP BY bus_number", {
+        "counters_bus_booked_insert": f"""
+            AFTER INSERT ON booking_info WHEN NEW.bus_number IS NOT NULL
+            BEGIN {_bump("'bus_booked:' || NEW.bus_number", "1")} END""",
+        "counters_bus_booked_update": f"""
+            AFTER UPDATE OF bus_number ON booking_info WHEN NEW.bus_number IS NOT OLD.bus_number
+            BEGIN
+                {_bump("'bus_booked:' || OLD.bus_number", "-(OLD.bus_number IS NOT NULL)")}
+                {_bump("'bus_booked:' || NEW.bus_number", "(NEW.bus_number IS NOT NULL)")}
+            END""",
+        "counters_bus_booked_delete": f"""
+            AFTER DELETE ON booking_info WHEN OLD.bus_number IS NOT NULL
+            BEGIN {_bump("'bus_booked:' || OLD.bus_number", "-1")} END""",
+    }),
+]
+
+# Indexes added after the tables were first created; create_all() only
+# creates indexes together with new tables
+EXTRA_INDEXES = [
+    # Superseded by ix_master_arrived_timestamp
+    "DROP INDEX IF EXISTS ix_master_arrived",
+    "CREATE INDEX IF NOT EXISTS ix_master_arrived_timestamp ON master (arrived, timestamp)",
+    "CREATE INDEX IF NOT EXISTS ix_processed_master_processed_by ON processed_master (processed_by)",
+]
+
+
+# Arrival log behind ArrivalEvent. Masters imported as already arrived get
+# an event too; without a timestamp they count as arriving now.
+ARRIVAL_TIME_SQL = "coalesce(NEW.timestamp, datetime('now', 'localtime'))"
+ARRIVAL_SEED = (
+    "INSERT INTO arrival_event (ITS, arrived_at) "
+    "SELECT ITS, coalesce(timestamp, datetime('now', 'localtime')) FROM master WHERE arrived = 1 ORDER BY timestamp, ITS"
+)
+ARRIVAL_TRIGGERS = {
+    "arrival_event_insert": f"""
+        AFTER INSERT ON master WHEN NEW.arrived IS 1
+        BEGIN INSERT INTO arrival_event (ITS, arrived_at) VALUES (NEW.ITS, {ARRIVAL_TIME_SQL}); END""",
+    "arrival_event_update": f"""
+        AFTER UPDATE OF arrived ON master WHEN (NEW.arrived IS 1) != (OLD.arrived IS 1)
+        BEGIN
+            DELETE FROM arrival_event WHERE ITS = OLD.ITS;
+            INSERT INTO arrival_event (ITS, arrived_at) SELECT NEW.ITS, {ARRIVAL_TIME_SQL} WHERE NEW.arrived IS 1;
+        END""",
+    "arrival_event_delete": """
+        AFTER DELETE ON master WHEN OLD.arrived IS 1
+        BEGIN DELETE FROM arrival_event WHERE ITS = OLD.ITS; END""",
+}
+
+
+# Name/passport search index (see search.py). The trigram tokenizer indexes
+# every three-character substring, so MATCH finds partial names; the rowid
+# is the master's ITS.
+# Writing to FTS5 from a trigger flushes its buffer on every statement,
+# which makes bulk imports several times slower, so the triggers only queue
+# changed ITS numbers in master_search_pending and the writer folds them
+# into the index with SEARCH_SYNC before it commits: ORM sessions on flush
+# (see sync_flushed_search), the importer once per file and restores once
+# per restore. Searching never writes.
+SEARCH_INDEX = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS master_search USING fts5(name, passport_No, tokenize = 'trigram')",
+    "CREATE TABLE IF NOT EXISTS master_search_pending (ITS INTEGER PRIMARY KEY)",
+]
+
+SEARCH_NAME_SQL = "trim(coalesce(first_name, '') || ' ' || coalesce(middle_name, '') || ' ' || coalesce(last_name, ''))"
+SEARCH_SEED = f"SELECT ITS, {SEARCH_NAME_SQL}, passport_No FROM master"
+SEARCH_SYNC = [
+    "DELETE FROM master_search WHERE rowid IN (SELECT ITS FROM master_search_pending)",
+    f"INSERT INTO master_search (rowid, name, passport_No) {SEARCH_SEED} WHERE ITS IN (SELECT ITS FROM master_search_pending)",
+    "DELETE FROM master_search_pending",
+]
+SEARCH_TRIGGERS = {
+    "master_search_insert": """
+        AFTER INSERT ON master
+        BEGIN INSERT OR IGNORE INTO master_search_pending (ITS) VALUES (NEW.ITS); END""",
+    "master_search_update": """
+        AFTER UPDATE OF ITS, first_name, middle_name, last_name, passport_No ON master
+        BEGIN
+            INSERT OR IGNORE INTO master_search_pending (ITS) VALUES (OLD.ITS);
+            INSERT OR IGNORE INTO master_search_pending (ITS) VALUES (NEW.ITS);
+        END""",
+    "master_search_delete": """
+        AFTER DELETE ON master
+        BEGIN INSERT OR IGNORE INTO master_search_pending (ITS) VALUES (OLD.ITS); END""",
+}
+
+
+def upgrade_schema(bind):
+    """
+    Idempotently add the indexes and triggers create_all() doesn't manage.
+    Counters, the arrival log and the search index are rebuilt whenever
+    their triggers are (re)installed.
+    """
+    with bind.begin() as conn:
+        for statement in EXTRA_INDEXES:
+            conn.exec_driver_sql(statement)
+        installed = set(conn.exec_driver_sql("SELECT name FROM sqlite_master WHERE type = 'trigger'").scalars())
+        for pattern, seed, triggers in COUNTER_TRIGGERS:
+            if set(triggers) <= installed:
+                continue
+            for name, body in triggers.items():
+                conn.exec_driver_sql(f"CREATE TRIGGER IF NOT EXISTS {name} {body}")
+            conn.exec_driver_sql("DELETE FROM counters WHERE name LIKE ?", (pattern,))
+            conn.exec_driver_sql(f"INSERT INTO counters (name, value) {seed}")
+        if not set(ARRIVAL_TRIGGERS) <= installed:
+            for name, body in ARRIVAL_TRIGGERS.items():
+                conn.exec_driver_sql(f"CREATE TRIGGER IF NOT EXISTS {name} {body}")
+            conn.exec_driver_sql("DELETE FROM arrival_event")
+            conn.exec_driver_sql(ARRIVAL_SEED)
+        for statement in SEARCH_INDEX:
+            conn.exec_driver_sql(statement)
+        if not set(SEARCH_TRIGGERS) <= installed:
+            for name, body in SEARCH_TRIGGERS.items():
+                conn.exec_driver_sql(f"CREATE TRIGGER IF NOT EXISTS {name} {body}")
+            conn.exec_driver_sql("DELETE FROM master_search")
+            conn.exec_driver_sql(f"INSERT INTO master_search (rowid, name, passport_No) {SEARCH_SEED}")
+            conn.exec_driver_sql("DELETE FROM master_search_pending")
+        elif conn.exec_driver_sql("SELECT 1 FROM master_search_pending LIMIT 1").first():
+            # Rows queued by a writer that did not sync
+            for statement in SEARCH_SYNC:
+                conn.exec_driver_sql(statement)
+
+
 # Create all tables in the database
 Base.metadata.create_all(bind=engine)
+upgrade_schema(engine)
+
+
+def read_counter(db_session: Session, name: str) -> int:
+    return db_session.query(Counter.value).filter(Counter.name == name).scalar() or 0
+
+
+async def read_counter_async(db_session: AsyncSession, name: str) -> int:
+    return (await db_session.scalar(select(Counter.value).where(Counter.name == name))) or 0
+
+
+def arrived_count(db_session: Session) -> int:
+    return read_counter(db_session, "arrived")
+
+
+def processed_count(db_session: Session, username: str) -> int:
+    return read_counter(db_session, f"processed:{username}")
+
+
+def bus_booked_counts(db_session: Session) -> dict:
+    rows = db_session.query(Counter.name, Counter.value).filter(Counter.name.like("bus_booked:%")).all()
+    return {int(name.split(":", 1)[1]): value for name, value in rows}
+
+
+# In-process Master cache shared by the desk apps
+
+class LRUCache:
+    """
+    Thread-safe LRU cache whose entries expire ttl seconds after being stored.
+    """
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def invalidate_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {"size": len(self._data), "maxsize": self.maxsize, "ttl": self.ttl, "hits": self.hits, "misses": self.misses}
+
+
+# Every desk runs in its own process, so the TTL bounds how long a change
+# made by another desk can go unnoticed
+MASTER_CACHE_SIZE = int(os.getenv("MASTER_CACHE_SIZE", 20000))
+MASTER_CACHE_TTL = float(os.getenv("MASTER_CACHE_TTL", 30))
+
+master_cache = LRUCache(MASTER_CACHE_SIZE, MASTER_CACHE_TTL)
+
+MASTER_COLUMNS = [column.key for column in Master.__table__.columns]
+
+
+def _cached_master(its: int):
+    # Detached copy of the cached row, ready for session.merge(load=False)
+    values = master_cache.get(its)
+    if values is None:
+        return None
+    master = Master(**values)
+    make_transient_to_detached(master)
+    return master
+
+
+def _cache_master(master):
+    if master is not None:
+        master_cache.put(master.ITS, {key: getattr(master, key) for key in MASTER_COLUMNS})
+    return master
+
+
+def fetch_master(db_session: Session, its: int):
+    """
+    Read-through lookup of a Master by ITS. Cache hits are merged into the
+    session without a SELECT, so the returned object can be updated as usual.
+    """
+    if its is None:
+        return None
+    its = int(its)
+    existing = db_session.identity_map.get(identity_key(Master, its))
+    if existing is not None:
+        return existing
+
+    cached = _cached_master(its)
+    if cached is not None:
+        return db_session.merge(cached, load=False)
+
+    return _cache_master(db_session.query(Master).filter(Master.ITS == its).first())
+
+
+async def fetch_master_async(db_session: AsyncSession, its: int):
+    """
+    fetch_master() for an AsyncSession.
+    """
+    if its is None:
+        return None
+    its = int(its)
+    existing = db_session.identity_map.get(identity_key(Master, its))
+    if existing is not None:
+        return existing
+
+    cached = _cached_master(its)
+    if cached is not None:
+        return await db_session.merge(cached, load=False)
+
+    result = await db_session.execute(select(Master).where(Master.ITS == its))
+    return _cache_master(result.scalars().first())
+
+
+def prefetch_masters(db_session: Session, its_list) -> int:
+    """
+    Load the masters in its_list into master_cache with one query, so the
+    fetch_master() calls that follow are served from memory. Returns how
+    many were found.
+    """
+    its_list = [int(its) for its in its_list]
+    if not its_list:
+        return 0
+    masters = db_session.query(Master).filter(Master.ITS.in_(its_list)).all()
+    for master in masters:
+        _cache_master(master)
+    return len(masters)
+
+
+@event.listens_for(Session, "after_flush")
+def collect_flushed_masters(session, flush_context):
+    # Any ORM write to a Master (update_master, mark_as_arrived, update_phone, ...)
+    # drops its cached copy once committed; Core-level bulk writes invalidate
+    # explicitly. Dropping it at flush time would let another request cache
+    # the old committed row again before this transaction commits.
+    changed = [obj.ITS for obj in list(session.dirty) + list(session.deleted) if isinstance(obj, Master)]
+    if changed:
+        session.info.setdefault("flushed_masters", set()).update(changed)
+
+
+@event.listens_for(Session, "after_flush")
+def sync_flushed_search(session, flush_context):
+    # Index the masters this flush queued, inside the same transaction, so
+    # a commit never leaves master_search behind
+    if not any(isinstance(obj, Master) for obj in list(session.new) + list(session.dirty) + list(session.deleted)):
+        return
+    connection = session.connection()
+    if connection.exec_driver_sql("SELECT 1 FROM master_search_pending LIMIT 1").first():
+        for statement in SEARCH_SYNC:
+            connection.exec_driver_sql(statement)
+
+
+@event.listens_for(Session, "after_commit")
+def invalidate_committed_masters(session):
+    changed = session.info.pop("flushed_masters", None)
+    if changed:
+        master_cache.invalidate_many(changed)
+
+
+@event.listens_for(Session, "after_rollback")
+def discard_flushed_masters(session):
+    session.info.pop("flushed_masters", None)
+
+
+# Session dependency shared by every desk router
+def get_db():
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+# Session dependency for async handlers. Handlers that use the sync
+# SessionLocal must be plain def so FastAPI runs them in its thread pool.
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
 
@@ -0,0 +1,162 @@
+"""
+In-process event bus for the live dashboards.
+
+Desks publish arrival, booking and customs events once their transaction
+has committed, and dashboards receive them as server-sent events instead
+of reloading whole tables. Every event gets an increasing id and the last
+EVENT_BUFFER events are kept, so a dashboard that reconnects (browsers send
+Last-Event-ID on their own) only receives what it missed. If it missed more
+than the buffer holds, or the process restarted, it gets a "reset" event
+and should reload its snapshot.
+
+The bus lives in one process. Run the desks together (service.py) to get a
+single feed; with several workers each worker streams its own events.
+"""
+import asyncio
+import json
+import os
+import threading
+from collections import deque
+from datetime import datetime
+from typing import Iterable, Optional
+
+EVENT_BUFFER = int(os.getenv("EVENT_BUFFER", 1000))
+# Events waiting for one slow client before it is disconnected (it then
+# reconnects and catches up from the buffer)
+EVENT_QUEUE_SIZE = int(os.getenv("EVENT_QUEUE_SIZE", 256))
+EVENT_HEARTBEAT = float(os.getenv("EVENT_HEARTBEAT", 15))
+
+EVENT_TYPES = ("arrival", "booking", "customs")
+
+
+class EventBus:
+    def __init__(self, buffer_size: int = EVENT_BUFFER, queue_size: int = EVENT_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._recent = deque(maxlen=buffer_size)
+        self._subscribers = {}
+        self._lock = threading.Lock()
+        self._last_id = 0
+
+    def publish(self, type: str, **data) -> dict:
+        """
+        Record an event and hand it to every subscriber. Safe to call from
+        the thread pool that runs the sync handlers.
+        """
+        with self._lock:
+            self._last_id += 1
+            event = {"id": self._last_id, "type": type, "time": datetime.now().isoformat(timespec="seconds"), "data": data}
+            self._recent.append(event)
+            subscribers = list(self._subscribers.items())
+        for queue, loop in subscribers:
+            try:
+                loop.call_soon_threadsafe(self._deliver, queue, event)
+            except RuntimeError:
+                # The subscriber's loop has closed
+                with self._lock:
+                    self._subscribers.pop(queue, None)
+        return event
+
+    @staticmethod
+    def _deliver(queue: asyncio.Queue, event: dict):
+        try:
+            queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # Too far behind: end the stream, the client resumes from the buffer
+            while not queue.empty():
+                queue.get_nowait()
+            queue.put_nowait(None)
+
+    def reset(self) -> dict:
+        """
+        Tell every dashboard to reload its snapshot, e.g. after a restore
+        rewrote the rows behind it. Subscribers get it whatever types they
+        asked for.
+        """
+        return self.publish("reset")
+
+    def since(self, last_id: Optional[int]) -> tuple:
+        """
+        Buffered events after last_id, and whether the client must reset
+        because events it never saw are gone.
+        """
+        with self._lock:
+            recent = list(self._recent)
+            current = self._last_id
+        if last_id is None:
+            return [], False
+        if last_id > current or (recent and recent[0]["id"] > last_id + 1):
+            return recent, True
+        return [event for event in recent if event["id"] > last_id], False
+
+    async def subscribe(self, last_id: Optional[int] = None, types: Optional[Iterable[str]] = None, heartbeat: float = EVENT_HEARTBEAT):
+        """
+        Yield events as they are published, starting after last_id. Yields
+        None every `heartbeat` seconds without events.
+        """
+        types = set(types) if types else None
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        with self._lock:
+            self._subscribers[queue] = asyncio.get_running_loop()
+        try:
+            backlog, reset = self.since(last_id)
+            if reset:
+                yield {"id": None, "type": "reset", "data": {}}
+            seen = 0 if reset else (last_id or 0)
+            for event in backlog:
+                seen = event["id"]
+                if types is None or event["type"] in types or event["type"] == "reset":
+                    yield event
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), heartbeat)
+                except asyncio.TimeoutError:
+                    yield None
+                    continue
+                if event is None:
+                    return
+                # Published while the backlog was being replayed
+                if event["id"] <= seen:
+                    continue
+                seen = event["id"]
+                if types is None or event["type"] in types or event["type"] == "reset":
+                    yield event
+        finally:
+            with self._lock:
+                self._subscribers.pop(queue, None)
+
+    def stats(self) -> dict:
+        return {"subscribers": len(self._subscribers), "last_id": self._last_id, "buffered": len(self._recent)}
+
+
+bus = EventBus()
+
+
+def publish(type: str, **data) -> dict:
+    return bus.publish(type, **data)
+
+
+def master_summary(master) -> dict:
+    """
+    What dashboards show for a master; works on Master objects and rows.
+    """
+    name = " ".join(part for part in (master.first_name, master.middle_name, master.last_name) if part)
+    return {"ITS": master.ITS, "name": name, "timestamp": master.timestamp}
+
+
+def format_sse(event: Optional[dict]) -> str:
+    if event is None:
+        # Comment line, keeps proxies from closing an idle stream
+        return ": heartbeat\n\n"
+    lines = []
+    if event["id"] is not None:
+        lines.append(f"id: {event['id']}")
+    lines.append(f"event: {event['type']}")
+    lines.append(f"data: {json.dumps({'time': event.get('time'), **event['data']}, default=str)}")
+    return "\n".join(lines) + "\n\n"
+
+
+async def sse_stream(last_id: Optional[int] = None, types: Optional[Iterable[str]] = None):
+    # Tell the browser how long to wait before reconnecting
+    yield "retry: 3000\n\n"
+    async for event in bus.subscribe(last_id, types):
+        yield format_sse(event)
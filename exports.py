@@ -0,0 +1,115 @@
+import csv
+import io
+import json
+import os
+from typing import Iterable, Iterator, Optional, Union
+
+from sqlalchemy import select
+
+from columnar import stream_columnar
+from database import engine, Master, BookingInfo
+
+# Rows fetched from the cursor per round; also the size of each chunk
+# written to the client
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", 1000))
+
+EXPORT_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+    # Compressed columnar file, see columnar.py
+    "wcol": "application/octet-stream",
+}
+
+MASTER_EXPORT_COLUMNS = [
+    Master.ITS, Master.first_name, Master.middle_name, Master.last_name, Master.DOB,
+    Master.passport_No, Master.passport_Expiry, Master.Visa_No, Master.Mode_of_Transport,
+    Master.phone, Master.arrived, Master.timestamp,
+]
+
+BOOKING_EXPORT_COLUMNS = [
+    BookingInfo.ITS, BookingInfo.Mode, BookingInfo.bus_number, BookingInfo.seat_number,
+    BookingInfo.Issued, BookingInfo.Departed, BookingInfo.Self_Issued,
+    Master.first_name, Master.middle_name, Master.last_name, Master.phone, Master.passport_No,
+]
+
+
+def masters_statement():
+    return select(*MASTER_EXPORT_COLUMNS).order_by(Master.ITS)
+
+
+def bookings_statement(bus_number: Optional[int] = None):
+    statement = select(*BOOKING_EXPORT_COLUMNS).join(Master, Master.ITS == BookingInfo.ITS)
+    if bus_number:
+        statement = statement.where(BookingInfo.bus_number == bus_number)
+    return statement.order_by(BookingInfo.bus_number, BookingInfo.seat_number)
+
+
+def stream_partitions(statement) -> Iterator[list]:
+    """
+    Run a column-only select on its own connection and yield the rows in
+    partitions of EXPORT_BATCH_SIZE, so memory stays flat however big the
+    result is. The connection is held until the generator finishes.
+    """
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True, yield_per=EXPORT_BATCH_SIZE).execute(statement)
+        for partition in result.mappings().partitions():
+            yield partition
+
+
+def stream_rows(statement) -> Iterator[dict]:
+    for partition in stream_partitions(statement):
+        yield from partition
+
+
+def _json_default(value):
+    # Dates and datetimes
+    return str(value)
+
+
+def to_ndjson(partitions: Iterable[list]) -> Iterator[str]:
+    for partition in partitions:
+        yield "".join(json.dumps(dict(row), default=_json_default) + "\n" for row in partition)
+
+
+def to_csv(partitions: Iterable[list], columns: list) -> Iterator[str]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([column.key for column in columns])
+    for partition in partitions:
+        writer.writerows(row.values() for row in partition)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def to_columnar(partitions: Iterable[list], columns: list) -> Iterator[bytes]:
+    """
+    Written one row group at a time, so memory stays bounded like the text
+    formats.
+    """
+    rows = (tuple(row.values()) for partition in partitions for row in partition)
+    return stream_columnar([column.key for column in columns], rows)
+
+
+def export_stream(statement, columns: list, fmt: str) -> Iterator[Union[str, bytes]]:
+    partitions = stream_partitions(statement)
+    if fmt == "csv":
+        return to_csv(partitions, columns)
+    if fmt == "wcol":
+        return to_columnar(partitions, columns)
+    return to_ndjson(partitions)
+
+
+def masters_json_document(key: str = "masters") -> Iterator[str]:
+    """
+    Stream {"masters": [{"ITS": ...}, ...]} without building the list.
+    """
+    yield '{"%s": [' % key
+    first = True
+    for partition in stream_partitions(select(Master.ITS).order_by(Master.ITS)):
+        chunk = ", ".join(json.dumps({"ITS": row["ITS"]}) for row in partition)
+        yield chunk if first else ", " + chunk
+        first = False
+    yield "]}"
@@ -0,0 +1,449 @@
+import csv
+import io
+import os
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+from functools import lru_cache
+from itertools import islice
+from threading import Lock
+from typing import BinaryIO, Iterable, Iterator, List, Optional, Tuple
+
+from sqlalchemy import insert, or_, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from database import Master, Group, GroupInfo, master_cache
+from search import sync_search_index
+
+# Rows per INSERT executemany / commit. Each batch is its own transaction so
+# the SQLite write lock is released between batches.
+DEFAULT_BATCH_SIZE = int(os.getenv("CSV_BATCH_SIZE", 2000))
+
+# Rows handed to a parser process at a time, and how many parser processes
+# to use. Files that fit in one chunk are parsed in-process.
+CHUNK_ROWS = int(os.getenv("CSV_CHUNK_ROWS", 5000))
+IMPORT_WORKERS = int(os.getenv("CSV_IMPORT_WORKERS", os.cpu_count() or 1))
+
+# Dates repeat a lot across a manifest (shared birthdays, batch-issued
+# passports), so parsed values are memoised per process
+DATE_CACHE_SIZE = 65536
+
+# Import modes: "insert" only adds new pilgrims, "upsert" also syncs the
+# identity columns of pilgrims that are already loaded
+IMPORT_MODES = ("insert", "upsert")
+
+# Columns an upsert is allowed to rewrite. Operational columns (phone,
+# arrived, timestamp, Mode_of_Transport) are owned by the desks and kept.
+SYNCED_COLUMNS = ("first_name", "middle_name", "last_name", "DOB", "passport_No", "passport_Expiry", "Visa_No")
+
+# Stay well below SQLite's bound parameter limit for IN (...) lookups
+MAX_IN_PARAMS = 900
+
+# Only the first errors are kept in the report, the rest are just counted
+MAX_REPORTED_ERRORS = 500
+
+# Recently started imports, newest last, so progress can be polled
+MAX_TRACKED_IMPORTS = 20
+import_progress = OrderedDict()
+# Imports run in worker threads while the progress endpoint reads
+_progress_lock = Lock()
+
+
+class RowError(ValueError):
+    pass
+
+
+class ImportReport:
+    def __init__(self, filename: Optional[str] = None, batch_size: int = DEFAULT_BATCH_SIZE, mode: str = "insert"):
+        self.id = uuid.uuid4().hex
+        self.filename = filename
+        self.batch_size = batch_size
+        self.mode = mode
+        self.status = "running"
+        self.rows = 0
+        self.inserted = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.failed = 0
+        self.batches = 0
+        self.errors = []
+        self.started = time.time()
+        self.finished = None
+
+        with _progress_lock:
+            import_progress[self.id] = self
+            while len(import_progress) > MAX_TRACKED_IMPORTS:
+                import_progress.popitem(last=False)
+
+    def add_error(self, line: int, its, message: str):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"line": line, "ITS_ID": its, "error": message})
+
+    def finish(self, status: str = "done"):
+        self.status = status
+        self.finished = time.time()
+
+    def as_dict(self):
+        elapsed = (self.finished or time.time()) - self.started
+        return {
+            "id": self.id,
+            "filename": self.filename,
+            "status": self.status,
+            "batch_size": self.batch_size,
+            "mode": self.mode,
+            "rows": self.rows,
+            "inserted": self.inserted,
+            "updated": self.updated,
+            "unchanged": self.unchanged,
+            "failed": self.failed,
+            "batches": self.batches,
+            "elapsed_seconds": round(elapsed, 3),
+            "rows_per_second": round(self.rows / elapsed, 1) if elapsed else None,
+            "errors": list(self.errors),
+            "errors_truncated": self.failed > len(self.errors),
+        }
+
+
+def recent_imports() -> List[ImportReport]:
+    """
+    Snapshot of the tracked imports, newest first.
+    """
+    with _progress_lock:
+        return list(reversed(import_progress.values()))
+
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def parse_date(raw: str) -> date:
+    """
+    Parse a '%Y-%m-%d' or '%d/%m/%Y' date. The format is picked from the
+    separator, so neither layout goes through a failed strptime first.
+    Raises ValueError for anything else.
+    """
+    raw = raw.strip()
+    if "/" in raw:
+        day, month, year = raw.split("/")
+    else:
+        year, month, day = raw.split("-")
+    if len(year) != 4:
+        raise ValueError(f"invalid date {raw!r}")
+    return date(int(year), int(month), int(day))
+
+
+def parse_row(row: dict) -> dict:
+    """
+    Turn one ITS_DATA.csv row into a dict of master table values.
+    Raises RowError with a readable message when the row can't be imported.
+    """
+    its_raw = (row.get("ITS_ID") or "").strip()
+    if not its_raw:
+        raise RowError("missing ITS_ID")
+    try:
+        its = int(its_raw)
+    except ValueError:
+        raise RowError(f"invalid ITS_ID {its_raw!r}")
+
+    full_name_parts = (row.get("Full_Name") or "").split()
+    if not full_name_parts:
+        raise RowError("missing Full_Name")
+
+    values = {}
+    for column, field in (("DOB", "Date of Birth"), ("passport_Expiry", "Passport Expiry Date")):
+        raw = row.get(field) or ""
+        try:
+            values[column] = parse_date(raw)
+        except ValueError:
+            raise RowError(f"invalid {field} {raw!r}")
+
+    return {
+        "ITS": its,
+        "first_name": full_name_parts[0],
+        "middle_name": full_name_parts[1] if len(full_name_parts) > 2 else "",
+        "last_name": full_name_parts[-1],
+        "DOB": values["DOB"],
+        "passport_No": row.get("Passoport Number"),
+        "passport_Expiry": values["passport_Expiry"],
+        "Visa_No": row.get("Visa Number"),
+        "Mode_of_Transport": "",
+        "phone": "",
+        "arrived": False,
+    }
+
+
+def open_csv_stream(fileobj: BinaryIO) -> io.TextIOWrapper:
+    # Decode the upload lazily instead of reading it into one string
+    return io.TextIOWrapper(fileobj, encoding="utf-8-sig", newline="")
+
+
+def iter_row_chunks(text_stream: Iterable[str], chunk_rows: int = CHUNK_ROWS) -> Iterator[Tuple[List[str], list]]:
+    """
+    Tokenize the CSV and group raw rows into chunks of (line, fields) pairs.
+    """
+    reader = csv.reader(text_stream)
+    header = next(reader, None)
+    if header is None:
+        return
+    chunk = []
+    for fields in reader:
+        if not fields:
+            continue
+        chunk.append((reader.line_num, fields))
+        if len(chunk) >= chunk_rows:
+            yield header, chunk
+            chunk = []
+    if chunk:
+        yield header, chunk
+
+
+def parse_chunk(header: List[str], chunk: list) -> Tuple[List[dict], list]:
+    """
+    Parse and validate one chunk of raw rows. Runs in the parser processes,
+    so it only returns plain data: (line, values) pairs for the parsed rows
+    and (line, ITS_ID, error) tuples for the rows that were rejected.
+    """
+    rows, errors = [], []
+    for line, fields in chunk:
+        row = dict(zip(header, fields))
+        try:
+            values = parse_row(row)
+        except RowError as e:
+            errors.append((line, row.get("ITS_ID"), str(e)))
+            continue
+        rows.append((line, values))
+    return rows, errors
+
+
+_parse_pool = None
+_parse_pool_lock = Lock()
+
+
+def get_parse_pool() -> ProcessPoolExecutor:
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is None:
+            _parse_pool = ProcessPoolExecutor(max_workers=IMPORT_WORKERS)
+        return _parse_pool
+
+
+def _parse_in_pool(first_chunks: list, chunks: Iterator) -> Iterator[Tuple[List[dict], list]]:
+    # Keep a bounded number of chunks in flight so a huge upload is never
+    # read into memory ahead of the writer
+    pool = get_parse_pool()
+    pending = deque(pool.submit(parse_chunk, header, chunk) for header, chunk in first_chunks)
+    try:
+        for header, chunk in chunks:
+            pending.append(pool.submit(parse_chunk, header, chunk))
+            if len(pending) >= IMPORT_WORKERS * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def parse_chunks(chunks: Iterator, parallel: bool = True) -> Iterator[Tuple[List[dict], list]]:
+    chunks = iter(chunks)
+    first_chunks = list(islice(chunks, 2))
+    if parallel and IMPORT_WORKERS > 1 and len(first_chunks) > 1:
+        yield from _parse_in_pool(first_chunks, chunks)
+        return
+    for header, chunk in first_chunks:
+        yield parse_chunk(header, chunk)
+    for header, chunk in chunks:
+        yield parse_chunk(header, chunk)
+
+
+def iter_master_rows(text_stream: Iterable[str], report: ImportReport, parallel: bool = True) -> Iterator[Tuple[int, dict]]:
+    """
+    Yield (line, values) for parsed master rows in file order, recording bad rows in the report.
+    Parsing runs in the process pool for files bigger than one chunk.
+    """
+    for rows, errors in parse_chunks(iter_row_chunks(text_stream), parallel):
+        report.rows += len(rows) + len(errors)
+        for line, its, message in errors:
+            report.add_error(line, its, message)
+        yield from rows
+
+
+def batched(rows: Iterable, size: int) -> Iterator[list]:
+    iterator = iter(rows)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def upsert_statement():
+    """
+    INSERT ... ON CONFLICT(ITS) DO UPDATE that only rewrites a row when one
+    of the synced columns actually differs from the uploaded value.
+    """
+    table = Master.__table__
+    statement = sqlite_insert(table)
+    excluded = statement.excluded
+    changed = or_(*[table.c[column].is_distinct_from(excluded[column]) for column in SYNCED_COLUMNS])
+    return statement.on_conflict_do_update(
+        index_elements=[table.c.ITS],
+        set_={column: excluded[column] for column in SYNCED_COLUMNS},
+        where=changed,
+    )
+
+
+def existing_its(db: Session, its_values: List[int]) -> set:
+    found = set()
+    its_values = list(set(its_values))
+    for start in range(0, len(its_values), MAX_IN_PARAMS):
+        chunk = its_values[start:start + MAX_IN_PARAMS]
+        found.update(db.execute(select(Master.ITS).where(Master.ITS.in_(chunk))).scalars())
+    return found
+
+
+def _record_written(report: ImportReport, params: List[dict], changed: int, existing: set):
+    # Core writes bypass the session, so cached copies are dropped here
+    if existing:
+        master_cache.invalidate_many(existing)
+    # rowcount counts both inserted rows and rows the upsert really updated
+    new_rows = len({values["ITS"] for values in params} - existing)
+    report.inserted += new_rows
+    report.updated += changed - new_rows
+    report.unchanged += len(params) - changed
+
+
+def _write_rows_one_by_one(db: Session, statement, batch: list, report: ImportReport):
+    # Slow path for a batch that hit a constraint: find out which rows are bad
+    for line, values in batch:
+        existing = existing_its(db, [values["ITS"]]) if report.mode == "upsert" else set()
+        try:
+            with db.begin_nested():
+                result = db.execute(statement, [values])
+            _record_written(report, [values], result.rowcount, existing)
+        except IntegrityError as e:
+            report.add_error(line, values["ITS"], f"rejected by database: {e.orig}")
+    db.commit()
+
+
+def write_batches(db: Session, rows: Iterable[Tuple[int, dict]], report: ImportReport):
+    statement = upsert_statement() if report.mode == "upsert" else insert(Master.__table__)
+    for batch in batched(rows, report.batch_size):
+        params = [values for _, values in batch]
+        existing = existing_its(db, [values["ITS"] for values in params]) if report.mode == "upsert" else set()
+        try:
+            result = db.execute(statement, params)
+            db.commit()
+            _record_written(report, params, result.rowcount, existing)
+        except IntegrityError:
+            db.rollback()
+            _write_rows_one_by_one(db, statement, batch, report)
+        report.batches += 1
+
+
+def import_master_csv(db: Session, fileobj: BinaryIO, filename: Optional[str] = None, batch_size: Optional[int] = None, mode: str = "insert", parallel: bool = True) -> ImportReport:
+    """
+    Stream an ITS_DATA.csv upload into the master table in batches.
+    Bad rows are reported instead of aborting the whole file. In "upsert"
+    mode pilgrims that already exist are updated in place (delta sync).
+    Parsing is spread over a process pool; this process only writes.
+    """
+    if mode not in IMPORT_MODES:
+        raise ValueError(f"Unknown import mode {mode!r}")
+    report = ImportReport(filename, batch_size or DEFAULT_BATCH_SIZE, mode)
+    text_stream = open_csv_stream(fileobj)
+    try:
+        write_batches(db, iter_master_rows(text_stream, report, parallel), report)
+        # Fold the imported rows into the search index in one statement
+        sync_search_index(db)
+        report.finish()
+    except Exception:
+        db.rollback()
+        report.finish("failed")
+        raise
+    finally:
+        # Leave closing the upload to its owner
+        text_stream.detach()
+    return report
+
+
+def import_family_groups(db: Session, fileobj: BinaryIO) -> dict:
+    """
+    Form one Group per head of family from the HOF_ID column: the HOF is the
+    leader and every other row pointing at it is a member. Heads of family
+    that already lead a group are skipped, so re-uploading is harmless.
+    Everything is validated with set queries and written in one transaction.
+    """
+    families = OrderedDict()
+    errors = []
+    text_stream = open_csv_stream(fileobj)
+    try:
+        reader = csv.DictReader(text_stream)
+        for row in reader:
+            hof_raw = (row.get("HOF_ID") or "").strip()
+            its_raw = (row.get("ITS_ID") or "").strip()
+            if not hof_raw:
+                continue
+            try:
+                hof, its = int(hof_raw), int(its_raw)
+            except ValueError:
+                errors.append({"line": reader.line_num, "ITS_ID": its_raw, "error": "invalid ITS_ID or HOF_ID"})
+                continue
+            members = families.setdefault(hof, [])
+            if its != hof:
+                members.append(its)
+    finally:
+        text_stream.detach()
+
+    known = existing_its(db, list(families) + [its for members in families.values() for its in members])
+    already_leading = set()
+    leaders = list(families)
+    for start in range(0, len(leaders), MAX_IN_PARAMS):
+        chunk = leaders[start:start + MAX_IN_PARAMS]
+        already_leading.update(db.execute(select(Group.leader_ITS).where(Group.leader_ITS.in_(chunk))).scalars())
+
+    new_families = {}
+    for hof, members in families.items():
+        if hof in already_leading:
+            continue
+        if hof not in known:
+            errors.append({"HOF_ID": hof, "error": "head of family not found in master"})
+            continue
+        unknown = [its for its in members if its not in known]
+        for its in unknown:
+            errors.append({"HOF_ID": hof, "ITS_ID": its, "error": "member not found in master"})
+        members = [its for its in dict.fromkeys(members) if its in known]
+        if members:
+            new_families[hof] = members
+
+    try:
+        if new_families:
+            db.execute(insert(Group.__table__), [{"leader_ITS": hof} for hof in new_families])
+            group_ids = {}
+            hofs = list(new_families)
+            for start in range(0, len(hofs), MAX_IN_PARAMS):
+                chunk = hofs[start:start + MAX_IN_PARAMS]
+                group_ids.update(
+                    (leader, group_id) for group_id, leader in
+                    db.execute(select(Group.ID, Group.leader_ITS).where(Group.leader_ITS.in_(chunk)))
+                )
+            db.execute(insert(GroupInfo.__table__), [
+                {"group_ID": group_ids[hof], "ITS": its}
+                for hof, members in new_families.items() for its in members
+            ])
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    return {
+        "families": len(families),
+        "groups_created": len(new_families),
+        "members_added": sum(len(members) for members in new_families.values()),
+        "skipped_existing": len(already_leading),
+        "errors": errors[:MAX_REPORTED_ERRORS],
+        "errors_truncated": len(errors) > MAX_REPORTED_ERRORS,
+    }
+
@@ -1,57 +1,51 @@
-from fastapi import FastAPI, Depends, Request, Form, HTTPException, File, UploadFile, APIRouter
+from fastapi import Depends, Request, Form, HTTPException, File, UploadFile, APIRouter
 from fastapi import Query, Path
 from typing import List  # Add this import
 from fastapi.responses import RedirectResponse,HTMLResponse, JSONResponse
-from fastapi.templating import Jinja2Templates
-from fastapi.staticfiles import StaticFiles
-from sqlalchemy.orm import Session
-from sqlalchemy import func, desc
-from database import SessionLocal, engine, Master, BookingInfo, Transport, Schedule, Transport, Bus, Plane, Train, GroupInfo, Group, ProcessedMaster, User
+from sqlalchemy.orm import Session, joinedload, selectinload
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import func, desc, insert
+from database import get_db, engine, Master, BookingInfo, Transport, Schedule, Transport, Bus, Plane, Train, GroupInfo, Group, ProcessedMaster, User, fetch_master, bus_booked_counts, read_counter, BusSeat, begin_immediate, get_async_db, fetch_master_async
 import os
 import csv
 import io
 from datetime import datetime
-from fastapi.responses import JSONResponse
-from datetime import datetime
-app = FastAPI()
-
-app.mount("/static", StaticFiles(directory="static"), name="static")
-
-templates = Jinja2Templates(directory="templates")
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
+from typing import Optional
+from importer import import_master_csv, recent_imports, IMPORT_MODES, import_family_groups, existing_its
+from exports import EXPORT_FORMATS, MASTER_EXPORT_COLUMNS, BOOKING_EXPORT_COLUMNS, masters_statement, bookings_statement, export_stream, stream_rows, masters_json_document
+from common import templates, desk_context, desk_url, desk_app
+from search import search_masters, SEARCH_LIMIT
+from events import publish, master_summary
 
-# Dependency to get the DB session
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+router = APIRouter()
 
 
 # Main Index code with login check
-@app.get("/")
+@router.get("/")
 def read_root(request: Request):
     return templates.TemplateResponse("home.html", {"request": request})
 
 
 # Customs Form
 
-@app.get("/master-form")
+@router.get("/master-form")
 def get_master_form(request: Request):
     return templates.TemplateResponse("master.html", {"request": request})
     
     
 
-@app.get("/master/")
+@router.get("/master/")
 def get_master_by_its(request: Request, its: int, db: Session = Depends(get_db)):
     print("Master data updated")
-    master = db.query(Master).filter(Master.ITS == int(its)).first()
+    master = fetch_master(db, its)
     if not master:
         raise HTTPException(status_code=404, detail="Master not found")
     return templates.TemplateResponse("master.html", {"request": request, "master": master})
 
-@app.post("/master/update", response_class=HTMLResponse)
-async def update_master(
+@router.post("/master/update", response_class=HTMLResponse)
+def update_master(
     request: Request,
     its: int = Form(...),
     first_name: str = Form(...),
@@ -62,7 +56,7 @@ async def update_master(
     Visa_No: str = Form(None),
     db: Session = Depends(get_db)
 ):
-    master = db.query(Master).filter(Master.ITS == int(its)).first()
+    master = fetch_master(db, its)
     if not master:
         raise HTTPException(status_code=404, detail="Master not found")
     
@@ -96,35 +90,76 @@ async def update_master(
     return templates.TemplateResponse("master.html", {"request": request, "master": master})
 
 
-@app.get("/master/info/", response_class=HTMLResponse)
-async def get_master_info(
+@router.get("/master/info/", response_class=HTMLResponse)
+def get_master_info(
     request: Request, 
     its: int = Query(..., description="ITS of the master to retrieve"), 
     db: Session = Depends(get_db)
 ):
-    master = db.query(Master).filter(Master.ITS == its).first()
+    master = fetch_master(db, its)
     if not master:
         raise HTTPException(status_code=404, detail="Master not found")
     return templates.TemplateResponse("master.html", {"request": request, "master": master})
 
-# Add a new route to display data from the Master table in lists of 10
-@app.get("/masters/", response_class=HTMLResponse)
-async def list_masters(request: Request, page: int = Query(1), db: Session = Depends(get_db)):
-    # Paginate the data
-    page_size = 10
-    offset = (page - 1) * page_size
-    masters = db.query(Master).offset(offset).limit(page_size).all()
+# Search masters by ITS, name or passport number (see search.py)
+@router.get("/search/")
+def search_page(
+    request: Request,
+    q: Optional[str] = Query(None),
+    limit: int = Query(SEARCH_LIMIT, ge=1, le=100),
+    db: Session = Depends(get_db)
+):
+    if q is None:
+        return templates.TemplateResponse("search.html", {"request": request})
+    return JSONResponse({"query": q, "results": search_masters(db, q, limit)})
+
+
+@router.get("/search/{term}", response_class=HTMLResponse)
+def search_results(request: Request, term: str, db: Session = Depends(get_db)):
+    results = search_masters(db, term)
+    return templates.TemplateResponse("search_results.html", {"request": request, "query": term, "results": results})
+
+# Keyset pagination: pages are addressed by the last (or first) key seen
+# instead of an OFFSET, so deep pages cost the same as the first one
+PAGE_SIZE = int(os.getenv("PAGE_SIZE", 10))
+MAX_PAGE_SIZE = 500
+
+def keyset_page(query, key_column, after: Optional[int], before: Optional[int], page_size: int):
+    """
+    Fetch one page of query ordered by key_column.
+    Returns (rows, has_previous, has_next).
+    """
+    if before is not None:
+        rows = query.filter(key_column < before).order_by(key_column.desc()).limit(page_size + 1).all()
+        has_previous = len(rows) > page_size
+        return rows[:page_size][::-1], has_previous, True
+    if after is not None:
+        query = query.filter(key_column > after)
+    rows = query.order_by(key_column).limit(page_size + 1).all()
+    return rows[:page_size], after is not None, len(rows) > page_size
+
+# Display data from the Master table one page at a time
+@router.get("/masters/", response_class=HTMLResponse)
+def list_masters(
+    request: Request,
+    after: Optional[int] = Query(None),
+    before: Optional[int] = Query(None),
+    page_size: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    db: Session = Depends(get_db)
+):
+    masters, has_previous, has_next = keyset_page(db.query(Master), Master.ITS, after, before, page_size)
 
-    # Get the total number of masters for pagination
-    total_masters = db.query(func.count(Master.ITS)).scalar()
+    # Total maintained by triggers in the counters table, no count(*) scan
+    total_masters = read_counter(db, "masters")
 
     return templates.TemplateResponse(
         "masters.html",
         {
             "request": request,
             "masters": masters,
-            "page": page,
             "page_size": page_size,
+            "has_previous": has_previous,
+            "has_next": has_next,
             "total_masters": total_masters
         },
     )
@@ -132,33 +167,35 @@ async def list_masters(request: Request, page: int = Query(1), db: Session = Dep
 
 
 # Mark as Arrived
-@app.get("/mark-as-arrived/")
-async def mark_as_arrived(its: int, db: Session = Depends(get_db)):
-    master = db.query(Master).filter(Master.ITS == its).first()
+@router.get("/mark-as-arrived/")
+def mark_as_arrived(request: Request, its: int, db: Session = Depends(get_db)):
+    master = fetch_master(db, its)
     if master:
+        newly_arrived = not master.arrived
         master.arrived = True
         master.timestamp = datetime.now()
         db.commit()
         db.refresh(master)
+        if newly_arrived:
+            publish("arrival", masters=[master_summary(master)], arrived_count=read_counter(db, "arrived"))
         message = f"ITS {its} marked as arrived successfully"
     else:
         message = f"No record found for ITS {its}"
-    return RedirectResponse(url=f"/mark-as-arrived-form/?its={its}&message={message}")
+    return RedirectResponse(url=desk_url(request, f"/mark-as-arrived-form/?its={its}&message={message}"))
 
-@app.get("/mark-as-arrived-form/")
-async def get_mark_as_arrived_form(request: Request, its: int = None, message: str = None, db: Session = Depends(get_db)):
+@router.get("/mark-as-arrived-form/")
+def get_mark_as_arrived_form(request: Request, its: int = None, message: str = None, db: Session = Depends(get_db)):
     
-    master = db.query(Master).filter(Master.ITS == its).first()
+    master = fetch_master(db, its)
     return templates.TemplateResponse("arrive.html", {"request": request, "master": master, "message": message})
 
 
 # assign SIM
 
-@app.route("/assign-sim-form", methods=["GET", "POST"])
-async def get_assign_sim_form(request: Request, its: int = Form(...)):
+@router.api_route("/assign-sim-form", methods=["GET", "POST"])
+def get_assign_sim_form(request: Request, its: Optional[int] = Form(None), db: Session = Depends(get_db)):
     if request.method == "POST":
-        db = SessionLocal()
-        master = db.query(Master).filter(Master.ITS == its).first()
+        master = fetch_master(db, its)
         if not master:
             raise HTTPException(status_code=404, detail="Master not found")
         return templates.TemplateResponse("assign_sim.html", {"request": request, "master": master})
@@ -166,9 +203,9 @@ async def get_assign_sim_form(request: Request, its: int = Form(...)):
         # Handle GET request here (if needed)
         return templates.TemplateResponse("assign_sim.html", {"request": request})
 
-@app.post("/assign-sim/", response_class=HTMLResponse)
-async def assign_sim(request: Request, its: int = Form(...), db: Session = Depends(get_db)):
-    master = db.query(Master).filter(Master.ITS == its).first()
+@router.post("/assign-sim/", response_class=HTMLResponse)
+def assign_sim(request: Request, its: int = Form(...), db: Session = Depends(get_db)):
+    master = fetch_master(db, its)
     if not master:
         raise HTTPException(status_code=404, detail="Master not found")
     
@@ -176,15 +213,15 @@ async def assign_sim(request: Request, its: int = Form(...), db: Session = Depen
     db.refresh(master)
     return templates.TemplateResponse("assign_sim.html", {"request": request, "master": master, "message": "SIM assigned successfully"})
 
-@app.post("/update-phone/", response_class=HTMLResponse)
-async def update_phone(request: Request, its: int = Form(...), phone_number: str = Form(...), db: Session = Depends(get_db)):
+@router.post("/update-phone/", response_class=HTMLResponse)
+def update_phone(request: Request, its: int = Form(...), phone_number: str = Form(...), db: Session = Depends(get_db)):
     existing_master = db.query(Master).filter(Master.phone == phone_number).first()
     if existing_master and existing_master.ITS != its:
         error_message = "This phone number is already assigned to another ITS"
-        master = db.query(Master).filter(Master.ITS == its).first()
+        master = fetch_master(db, its)
         return templates.TemplateResponse("assign_sim.html", {"request": request, "master": master, "error": error_message})
     
-    master = db.query(Master).filter(Master.ITS == its).first()
+    master = fetch_master(db, its)
     if not master:
         raise HTTPException(status_code=404, detail="Master not found")
     
@@ -195,45 +232,40 @@ async def update_phone(request: Request, its: int = Form(...), phone_number: str
 
 # Bus Booking 
 
-@app.get("/bus-booking/", response_class=HTMLResponse)
-async def get_bus_booking_form(request: Request, its: int = Query(None), db: Session = Depends(get_db)):
+@router.get("/bus-booking/", response_class=HTMLResponse)
+def get_bus_booking_form(request: Request, its: int = Query(None), db: Session = Depends(get_db)):
     person = None
     buses = db.query(Bus).all()  # Fetch all buses
     search = its  # To display in the template if no person found
 
     if its:
-        person = db.query(Master).filter(Master.ITS == its).first()
+        person = fetch_master(db, its)
     
     return templates.TemplateResponse("bus_booking.html", {"request": request, "person": person, "buses": buses, "search": search})
 
 from sqlalchemy.exc import IntegrityError
 
-@app.post("/book-bus/", response_class=HTMLResponse)
-async def post_book_bus(
+@router.post("/book-bus/", response_class=HTMLResponse)
+def post_book_bus(
     request: Request,
     its: int = Form(...),
     bus_number: str = Form(...),
     db: Session = Depends(get_db)
 ):
     try:
+        # Seat claim, booking and seat count change in one write transaction
+        begin_immediate(db)
+
         # Check if bus exists and fetch its details
         bus = db.query(Bus).filter(Bus.bus_number == bus_number).first()
         if not bus:
             raise HTTPException(status_code=404, detail=f"Bus {bus_number} not found")
 
-        # Check if there are available seats
-        if bus.no_of_seats <= 0:
+        # Claim the lowest free seat
+        seat_number = BusSeat.claim(db, bus.bus_number, its)
+        if seat_number is None:
             raise HTTPException(status_code=400, detail="No available seats for this bus")
 
-        # Fetch the next available seat number
-        booked_seats = db.query(BookingInfo.seat_number).filter(
-            BookingInfo.bus_number == bus_number
-        ).all()
-        booked_seats = [seat[0] for seat in booked_seats if seat[0] is not None]
-        next_seat_number = 1
-        while next_seat_number in booked_seats:
-            next_seat_number += 1
-
         # Book the seat
         new_booking = BookingInfo(
             ITS=its,
@@ -241,18 +273,18 @@ async def post_book_bus(
             Issued=True,
             Departed=False,
             Self_Issued=True,
-            seat_number=next_seat_number,
-            bus_number=bus_number
+            seat_number=seat_number,
+            bus_number=bus.bus_number
         )
         db.add(new_booking)
-        db.commit()
 
         # Decrement available seats
-        bus.no_of_seats -= 1
+        bus.no_of_seats = Bus.no_of_seats - 1
         db.commit()
+        publish("booking", bookings=[{"ITS": its, "bus_number": bus.bus_number, "seat_number": seat_number}])
 
         # Retrieve person and buses for template
-        person = db.query(Master).filter(Master.ITS == its).first()
+        person = fetch_master(db, its)
         buses = db.query(Bus).all()
 
         return templates.TemplateResponse(
@@ -261,13 +293,13 @@ async def post_book_bus(
                 "request": request,
                 "person": person,
                 "buses": buses,
-                "error": "No available seats for this bus"  # Pass the error message here
+                "message": f"Seat {seat_number} booked on bus {bus.bus_number}"
             },
         )
 
     except IntegrityError as e:
         db.rollback()
-        person = db.query(Master).filter(Master.ITS == its).first()
+        person = fetch_master(db, its)
         buses = db.query(Bus).all()
         return templates.TemplateResponse(
             "bus_booking.html",
@@ -281,7 +313,7 @@ async def post_book_bus(
 
     except Exception as e:
         db.rollback()
-        person = db.query(Master).filter(Master.ITS == its).first()
+        person = fetch_master(db, its)
         buses = db.query(Bus).all()
         return templates.TemplateResponse(
             "bus_booking.html",
@@ -299,45 +331,70 @@ async def post_book_bus(
 from fastapi import Query
 from typing import Optional
 
-@app.get("/view-booking-info/", response_class=HTMLResponse)
-async def view_booking_info(request: Request, bus_number: Optional[int] = Query(None), db: Session = Depends(get_db)):
-    # Filter by bus number if provided
-    if bus_number:
-        booking_info = db.query(BookingInfo, Master).join(Master).filter(BookingInfo.bus_number == bus_number).all()
-    else:
-        # If no bus number provided, fetch all booking info
-        booking_info = db.query(BookingInfo, Master).join(Master).all()
-    return templates.TemplateResponse("view_booking_info.html", {"request": request, "booking_info": booking_info})
+@router.get("/view-booking-info/", response_class=HTMLResponse)
+def view_booking_info(request: Request, bus_number: Optional[int] = Query(None)):
+    # Rendered while the rows are read, so the page never holds every booking in memory
+    booking_info = stream_rows(bookings_statement(bus_number))
+    template = templates.get_template("view_booking_info.html")
+    return StreamingResponse(
+        template.generate(request=request, booking_info=booking_info, bus_number=bus_number, **desk_context(request)),
+        media_type="text/html",
+    )
+
+# Streaming exports (NDJSON or CSV stream in constant memory; wcol is the
+# compressed columnar format from columnar.py)
+
+@router.get("/export/masters.{fmt}")
+def export_masters(fmt: str):
+    if fmt not in EXPORT_FORMATS:
+        raise HTTPException(status_code=404, detail=f"Unknown export format {fmt}")
+    return StreamingResponse(
+        export_stream(masters_statement(), MASTER_EXPORT_COLUMNS, fmt),
+        media_type=EXPORT_FORMATS[fmt],
+        headers={"Content-Disposition": f"attachment; filename=masters.{fmt}"},
+    )
+
+@router.get("/export/bookings.{fmt}")
+def export_bookings(fmt: str, bus_number: Optional[int] = Query(None)):
+    if fmt not in EXPORT_FORMATS:
+        raise HTTPException(status_code=404, detail=f"Unknown export format {fmt}")
+    filename = f"bookings_bus_{bus_number}.{fmt}" if bus_number else f"bookings.{fmt}"
+    return StreamingResponse(
+        export_stream(bookings_statement(bus_number), BOOKING_EXPORT_COLUMNS, fmt),
+        media_type=EXPORT_FORMATS[fmt],
+        headers={"Content-Disposition": f"attachment; filename={filename}"},
+    )
 
 # view busses
 
-@app.get("/view-buses/")
+@router.get("/view-buses/")
 def view_buses(request: Request, db: Session = Depends(get_db)):
     buses = db.query(Bus).all()
-    return templates.TemplateResponse("view_buses.html", {"request": request, "buses": buses})
+    booked_counts = bus_booked_counts(db)
+    return templates.TemplateResponse("view_buses.html", {"request": request, "buses": buses, "booked_counts": booked_counts})
 
 # view planes
 
-@app.get("/view-planes/")
+@router.get("/view-planes/")
 def view_planes(request: Request, db: Session = Depends(get_db)):
     planes = db.query(Plane).all()
     return templates.TemplateResponse("view_planes.html", {"request": request, "planes": planes})
 
 # view trains
 
-@app.get("/view-trains/")
+@router.get("/view-trains/")
 def view_trains(request: Request, db: Session = Depends(get_db)):
     trains = db.query(Train).all()
     return templates.TemplateResponse("view_trains.html", {"request": request, "trains": trains})
 
 # add buss
 
-@app.get("/add-bus/")
+@router.get("/add-bus/")
 def get_add_bus(request: Request):
     return templates.TemplateResponse("add_bus.html", {"request": request})
 
 
-@app.post("/add-bus/")
+@router.post("/add-bus/")
 def post_add_bus(request: Request, no_of_seats: int = Form(...), type: str = Form(...), db: Session = Depends(get_db)):
     # # Get the highest bus number from the database
     # try:
@@ -351,140 +408,183 @@ def post_add_bus(request: Request, no_of_seats: int = Form(...), type: str = For
     
     new_bus = Bus(bus_number=next_bus_number, no_of_seats=no_of_seats, type=type)
     db.add(new_bus)
+    db.flush()
+    BusSeat.ensure_seats(db, next_bus_number)
     db.commit()
-    return RedirectResponse(url="/view-buses/", status_code=303)
+    return RedirectResponse(url=desk_url(request, "/view-buses/"), status_code=303)
 
 
 # add plane
 
-@app.get("/add-plane/")
+@router.get("/add-plane/")
 def get_add_plane(request: Request):
     return templates.TemplateResponse("add_plane.html", {"request": request})
 
-@app.post("/add-plane/")
+@router.post("/add-plane/")
 def post_add_plane(request: Request, company: str = Form(...), type: str = Form(...), departure_time: str = Form(...), db: Session = Depends(get_db)):
     new_plane = Plane(company=company, type=type, departure_time=datetime.strptime(departure_time, '%Y-%m-%d').date())
     db.add(new_plane)
     db.commit()
-    return RedirectResponse(url="/view-planes/", status_code=303)
+    return RedirectResponse(url=desk_url(request, "/view-planes/"), status_code=303)
 
 
 # add train
 
-@app.get("/add-train/")
+@router.get("/add-train/")
 def get_add_train(request: Request):
     return templates.TemplateResponse("add_train.html", {"request": request})
 
-@app.post("/add-train/")
+@router.post("/add-train/")
 def post_add_train(request: Request, company: str = Form(...), type: str = Form(...), departure_time: str = Form(...), db: Session = Depends(get_db)):
     new_train = Train(company=company, type=type, departure_time=datetime.strptime(departure_time, '%Y-%m-%d').date())
     db.add(new_train)
     db.commit()
-    return RedirectResponse(url="/view-trains/", status_code=303)
+    return RedirectResponse(url=desk_url(request, "/view-trains/"), status_code=303)
 
 # upload csv
 
-@app.get("/upload-csv/")
+@router.get("/upload-csv/")
 def get_upload_csv(request: Request):
     return templates.TemplateResponse("upload_csv.html", {"request": request})
 
 import uuid
 
-@app.post("/upload-csv/")
-async def post_upload_csv(request: Request, file: UploadFile = File(...), db: Session = Depends(get_db)):
-    content = await file.read()
-    csv_reader = csv.DictReader(io.StringIO(content.decode()))
-    
-    for row in csv_reader:
-        full_name_parts = row["Full_Name"].split()
-        first_name = full_name_parts[0]
-        middle_name = full_name_parts[1] if len(full_name_parts) > 2 else ""
-        last_name = full_name_parts[-1]
-        
-        # Parse date of birth
-        dob_raw = row["Date of Birth"]
-        try:
-            dob = datetime.strptime(dob_raw, '%Y-%m-%d').date()
-        except ValueError:
-            dob = datetime.strptime(dob_raw, '%d/%m/%Y').date()  # Try another format
-        
-        # Parse passport expiry date
-        expiry_date_raw = row["Passport Expiry Date"]
-        try:
-            expiry_date = datetime.strptime(expiry_date_raw, '%Y-%m-%d').date()
-        except ValueError:
-            expiry_date = datetime.strptime(expiry_date_raw, '%d/%m/%Y').date()  # Try another format
-                
-        new_master = Master(
-            ITS=row["ITS_ID"],
-            first_name=first_name,
-            middle_name=middle_name,
-            last_name=last_name,
-            DOB=dob,
-            passport_No=row["Passoport Number"],
-            passport_Expiry=expiry_date,
-            Visa_No=row["Visa Number"],
-            Mode_of_Transport="",
-            phone = ""
-        )
-        db.add(new_master)
-    
-    db.commit()
-    return RedirectResponse(url="/", status_code=303)
+@router.post("/upload-csv/")
+async def post_upload_csv(request: Request, file: UploadFile = File(...), batch_size: Optional[int] = Form(None), mode: str = Form("insert"), db: Session = Depends(get_db)):
+    if mode not in IMPORT_MODES:
+        raise HTTPException(status_code=400, detail=f"Unknown import mode {mode}")
+    await run_in_threadpool(import_master_csv, db, file.file, file.filename, batch_size, mode)
+    return RedirectResponse(url=desk_url(request, "/"), status_code=303)
+
+# Same import, but answers with the full report (counts and per-row errors)
+@router.post("/upload-csv/import/", response_class=JSONResponse)
+async def post_upload_csv_import(file: UploadFile = File(...), batch_size: Optional[int] = Form(None), mode: str = Form("insert"), db: Session = Depends(get_db)):
+    if mode not in IMPORT_MODES:
+        raise HTTPException(status_code=400, detail=f"Unknown import mode {mode}")
+    report = await run_in_threadpool(import_master_csv, db, file.file, file.filename, batch_size, mode)
+    return JSONResponse(content=report.as_dict())
+
+@router.get("/upload-csv/progress/", response_class=JSONResponse)
+def get_upload_csv_progress():
+    return JSONResponse(content=[report.as_dict() for report in recent_imports()])
 
 # Group Registration
 
-@app.get("/register-group/", response_class=HTMLResponse)
+@router.get("/register-group/", response_class=HTMLResponse)
 async def get_group_registration_form(request: Request):
     return templates.TemplateResponse("group_registration.html", {"request": request})
 
 # Route to handle group registration form submission
-@app.post("/register-group/", response_class=HTMLResponse)
-async def register_group(
+@router.post("/register-group/", response_class=HTMLResponse)
+def register_group(
     request: Request,
     leader_its: int = Form(...),
-    member_its: List[int] = Form(...),
+    member_its: List[str] = Form(...),
     db: Session = Depends(get_db)
 ):
+    # Members come either as repeated fields or as one comma separated field
     try:
-        # Check if the leader exists
-        leader = db.query(Master).filter(Master.ITS == leader_its).first()
-        if not leader:
-            raise HTTPException(status_code=404, detail="Leader not found")
+        members = list(dict.fromkeys(int(its) for value in member_its for its in value.replace(",", " ").split()))
+    except ValueError:
+        return templates.TemplateResponse("group_registration.html", {"request": request, "error": "Member ITS must be numbers"})
 
-        # Create a new group
+    try:
+        # Validate the leader and every member with one query
+        found = existing_its(db, [leader_its] + members)
+        if leader_its not in found:
+            return templates.TemplateResponse("group_registration.html", {"request": request, "error": f"Leader {leader_its} not found"})
+        missing = [its for its in members if its not in found]
+        if missing:
+            return templates.TemplateResponse("group_registration.html", {"request": request, "error": f"Members not found: {', '.join(map(str, missing))}"})
+
+        # Create the group and all its members in one transaction
         new_group = Group(leader_ITS=leader_its)
         db.add(new_group)
+        db.flush()
+        if members:
+            db.execute(insert(GroupInfo.__table__), [{"group_ID": new_group.ID, "ITS": its} for its in members])
         db.commit()
 
-        # Add members to the group
-        for member_its in member_its:
-            member = db.query(Master).filter(Master.ITS == member_its).first()
-            if member:
-                group_info = GroupInfo(group_ID=new_group.ID, ITS=member_its)
-                db.add(group_info)
-
-        db.commit()
-
-        return templates.TemplateResponse("group_registration.html", {"request": request, "message": "Group registered successfully"})
+        return templates.TemplateResponse("group_registration.html", {"request": request, "message": f"Group {new_group.ID} registered with {len(members)} members"})
 
     except Exception as e:
         db.rollback()
         return templates.TemplateResponse("group_registration.html", {"request": request, "error": "Failed to register group. Please try again."})
 
+# Form families from the HOF_ID column of an ITS_DATA.csv upload
+@router.post("/register-groups/upload/", response_class=JSONResponse)
+async def upload_family_groups(file: UploadFile = File(...), db: Session = Depends(get_db)):
+    report = await run_in_threadpool(import_family_groups, db, file.file)
+    return JSONResponse(content=report)
+
+
+# Get all groups, one page at a time, with leaders and members eager-loaded
+def load_groups_page(db: Session, after: Optional[int], before: Optional[int], page_size: int):
+    query = db.query(Group).options(joinedload(Group.leader), selectinload(Group.members))
+    groups, has_previous, has_next = keyset_page(query, Group.ID, after, before, page_size)
+    member_counts = dict(
+        db.query(GroupInfo.group_ID, func.count(GroupInfo.ID))
+        .filter(GroupInfo.group_ID.in_([group.ID for group in groups]))
+        .group_by(GroupInfo.group_ID)
+        .all()
+    ) if groups else {}
+    return groups, member_counts, has_previous, has_next
 
-# Get all groups
-@app.get("/view-all-groups", response_class=HTMLResponse)
-async def get_all_groups(request: Request, db: Session = Depends(get_db)):
-    groups = db.query(GroupInfo).all()
-    return templates.TemplateResponse("view_all_groups.html", {"request": request, "groups": groups})
+def member_summary(master: Optional[Master]):
+    if master is None:
+        return None
+    return {
+        "ITS": master.ITS,
+        "name": " ".join(part for part in (master.first_name, master.middle_name, master.last_name) if part),
+        "arrived": bool(master.arrived),
+    }
+
+@router.get("/view-all-groups", response_class=HTMLResponse)
+def get_all_groups(
+    request: Request,
+    after: Optional[int] = Query(None),
+    before: Optional[int] = Query(None),
+    page_size: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    db: Session = Depends(get_db)
+):
+    groups, member_counts, has_previous, has_next = load_groups_page(db, after, before, page_size)
+    return templates.TemplateResponse("view_all_groups.html", {
+        "request": request,
+        "groups": groups,
+        "member_counts": member_counts,
+        "page_size": page_size,
+        "has_previous": has_previous,
+        "has_next": has_next,
+    })
+
+@router.get("/api/groups/", response_class=JSONResponse)
+def get_groups_api(
+    after: Optional[int] = Query(None),
+    before: Optional[int] = Query(None),
+    page_size: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    db: Session = Depends(get_db)
+):
+    groups, member_counts, has_previous, has_next = load_groups_page(db, after, before, page_size)
+    return JSONResponse(content={
+        "groups": [
+            {
+                "ID": group.ID,
+                "leader": member_summary(group.leader),
+                "member_count": member_counts.get(group.ID, 0),
+                "members": [member_summary(member) for member in group.members],
+            }
+            for group in groups
+        ],
+        "previous": f"/api/groups/?before={groups[0].ID}&page_size={page_size}" if groups and has_previous else None,
+        "next": f"/api/groups/?after={groups[-1].ID}&page_size={page_size}" if groups and has_next else None,
+    })
 
 
 # APIs
 
-@app.get("/{its}")
-def get_master(its: int, db: Session = Depends(get_db)):
-    master = db.query(Master).filter(Master.ITS == its).first()
+@router.get("/{its}")
+async def get_master(its: int, db: AsyncSession = Depends(get_async_db)):
+    master = await fetch_master_async(db, its)
     if not master:
         return JSONResponse(status_code=404, content={"error": "Master not found"})
     
@@ -500,36 +600,35 @@ def get_master(its: int, db: Session = Depends(get_db)):
 
 from fastapi import Depends
 
-@app.get("/get_masters/")
+@router.get("/get_masters/")
 def get_all_masters(db: Session = Depends(get_db)):
-    masters = db.query(Master).all()
-    if not masters:
+    if not read_counter(db, "masters"):
         raise HTTPException(status_code=404, detail="No masters found")
     
-    masters_data = [{"ITS": master.ITS} for master in masters]
-    
-    return {"masters": masters_data}
+    return StreamingResponse(masters_json_document(), media_type="application/json")
 
-@app.post("/create-booking/", response_class=JSONResponse)
-async def create_booking(
+@router.post("/create-booking/", response_class=JSONResponse)
+def create_booking(
     its: int = Form(...),
     seat_number: int = Form(...),
     bus_number: int = Form(...),
     db: Session = Depends(get_db)
 ):
     # Check if ITS exists
-    person = db.query(Master).filter(Master.ITS == its).first()
+    person = fetch_master(db, its)
     if not person:
         raise HTTPException(status_code=404, detail="Master not found")
 
+    begin_immediate(db)
+
     # Check if bus exists
     bus = db.query(Bus).filter(Bus.bus_number == bus_number).first()
     if not bus:
         raise HTTPException(status_code=404, detail="Bus not found")
 
-    # Check if the seat is available
-    existing_booking = db.query(BookingInfo).filter(BookingInfo.bus_number == bus_number, BookingInfo.seat_number == seat_number).first()
-    if existing_booking:
+    # Claim the requested seat, fails if another desk already has it
+    if BusSeat.claim(db, bus_number, its, seat_number) is None:
+        db.rollback()
         raise HTTPException(status_code=400, detail="Seat already booked")
 
     # Create new booking
@@ -543,61 +642,136 @@ async def create_booking(
         bus_number=bus_number
     )
 
-    # Add the new booking to the session and commit
+    # Add the new booking and decrement available seats in one commit
     db.add(new_booking)
-    db.commit()
-
-    # Decrement available seats
-    bus.no_of_seats -= 1
-    db.commit()
+    bus.no_of_seats = Bus.no_of_seats - 1
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(status_code=400, detail="ITS already has a booking")
+    publish("booking", bookings=[{"ITS": its, "bus_number": bus_number, "seat_number": seat_number}])
 
     return JSONResponse(content={"message": "Booking created successfully"})
 
 
-router = APIRouter()
-PAGE_SIZE = 10
+# Seat a whole group in one transaction, spilling over to the next buses
+@router.post("/book-group-bus/", response_class=JSONResponse)
+def book_group_bus(
+    bus_number: int = Form(...),
+    group_id: Optional[int] = Form(None),
+    leader_its: Optional[int] = Form(None),
+    db: Session = Depends(get_db)
+):
+    begin_immediate(db)
+
+    if group_id is not None:
+        group = db.query(Group).filter(Group.ID == group_id).first()
+    elif leader_its is not None:
+        group = db.query(Group).filter(Group.leader_ITS == leader_its).order_by(Group.ID).first()
+    else:
+        raise HTTPException(status_code=400, detail="Provide group_id or leader_its")
+    if not group:
+        raise HTTPException(status_code=404, detail="Group not found")
+
+    # Leader first, then members in registration order
+    member_its = [group.leader_ITS] + [
+        its for its, in db.query(GroupInfo.ITS).filter(GroupInfo.group_ID == group.ID).order_by(GroupInfo.ID)
+    ]
+    member_its = [its for its in dict.fromkeys(member_its) if its is not None]
+
+    already_booked = {
+        its for its, in db.query(BookingInfo.ITS).filter(BookingInfo.Mode == 1, BookingInfo.ITS.in_(member_its))
+    }
+    to_seat = [its for its in member_its if its not in already_booked]
+
+    buses = (
+        db.query(Bus)
+        .filter(Bus.bus_number >= bus_number)
+        .order_by(Bus.bus_number)
+        .all()
+    )
+    if not buses or buses[0].bus_number != bus_number:
+        raise HTTPException(status_code=404, detail="Bus not found")
+
+    bookings = []
+    for bus in buses:
+        if not to_seat:
+            break
+        seated = BusSeat.claim_block(db, bus.bus_number, to_seat)
+        if not seated:
+            continue
+        bus.no_of_seats = Bus.no_of_seats - len(seated)
+        bookings.extend(
+            {
+                "ITS": its,
+                "Mode": 1,  # assuming '1' represents 'bus' in your context
+                "Issued": True,
+                "Departed": False,
+                "Self_Issued": True,
+                "seat_number": seat,
+                "bus_number": bus.bus_number,
+            }
+            for its, seat in seated
+        )
+        to_seat = to_seat[len(seated):]
+
+    if to_seat:
+        db.rollback()
+        raise HTTPException(status_code=409, detail=f"Not enough free seats from bus {bus_number} onwards for {len(to_seat)} members")
+
+    if bookings:
+        db.execute(insert(BookingInfo.__table__), bookings)
+    db.commit()
+    if bookings:
+        publish("booking", bookings=[{"ITS": b["ITS"], "bus_number": b["bus_number"], "seat_number": b["seat_number"]} for b in bookings])
+
+    return JSONResponse(content={
+        "group_id": group.ID,
+        "booked": [{"ITS": b["ITS"], "bus_number": b["bus_number"], "seat_number": b["seat_number"]} for b in bookings],
+        "already_booked": sorted(already_booked),
+    })
+
 
 # Get users
 # def get_users(db: Session) -> List[User]:
 #     return db.query(User).all()
 
 
-@app.get("/processed-masters/", response_class=HTMLResponse)
-async def get_processed_masters(
+@router.get("/processed-masters/", response_class=HTMLResponse)
+def get_processed_masters(
     request: Request, 
-    page: int = 1, 
+    after: Optional[int] = Query(None),
+    before: Optional[int] = Query(None),
+    page_size: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
     db: Session = Depends(get_db)
 ):
     users = db.query(User).all()
     users = list(users)
-    total_count = db.query(func.count(ProcessedMaster.ITS)).scalar()
-    processed_masters = (
-        db.query(ProcessedMaster)
-        .offset((page - 1) * PAGE_SIZE)
-        .limit(PAGE_SIZE)
-        .all()
-    )
+    total_count = read_counter(db, "processed")
+    processed_masters, has_previous, has_next = keyset_page(db.query(ProcessedMaster), ProcessedMaster.id, after, before, page_size)
     return templates.TemplateResponse(
         "processed_masters.html", 
         {
             "request": request, 
             "processed_masters": processed_masters, 
-            "page": page,
-            "page_size": PAGE_SIZE,
+            "after": after,
+            "page_size": page_size,
+            "has_previous": has_previous,
+            "has_next": has_next,
             "total_count": total_count,
             "users": users,  # Pass the users list to the template# Pass the current user to the template
         }
     )
 
 
-@app.post("/print-processed-masters/", response_class=HTMLResponse)
-async def print_processed_masters(page: int = Form(...), db: Session = Depends(get_db)):
-    processed_masters = (
-        db.query(ProcessedMaster)
-        .offset((page - 1) * PAGE_SIZE)
-        .limit(PAGE_SIZE)
-        .all()
-    )
+@router.post("/print-processed-masters/", response_class=HTMLResponse)
+def print_processed_masters(
+    after: Optional[int] = Form(None),
+    page_size: int = Form(PAGE_SIZE),
+    db: Session = Depends(get_db)
+):
+    processed_masters, _, _ = keyset_page(db.query(ProcessedMaster), ProcessedMaster.id, after, None, min(page_size, MAX_PAGE_SIZE))
 
     if not processed_masters:
         raise HTTPException(status_code=400, detail="No processed masters found for printing")
@@ -610,7 +784,7 @@ async def print_processed_masters(page: int = Form(...), db: Session = Depends(g
 
     return HTMLResponse(content=html_content)
 
-@app.get("/booking-info/{bus_number}/")
+@router.get("/booking-info/{bus_number}/")
 def get_booking_info_for_bus(bus_number: int = Path(...), db: Session = Depends(get_db)):
     bookings = db.query(BookingInfo).filter(BookingInfo.bus_number == bus_number).all()
     if not bookings:
@@ -621,10 +795,12 @@ def get_booking_info_for_bus(bus_number: int = Path(...), db: Session = Depends(
         "seat_number": booking.seat_number
     } for booking in bookings])
     
-@app.get("/bus/")
+@router.get("/bus/")
 def get_bus_info(db: Session = Depends(get_db)):
     bus = db.query(Bus).all()
     
+app = desk_app(router)
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT", 8000)))
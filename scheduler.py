@@ -0,0 +1,151 @@
+"""
+A small asyncio job scheduler that runs inside the app's lifespan.
+
+Jobs run every `interval` seconds with random jitter, so several workers or
+jobs don't all fire at once. Coroutine functions are awaited on the event
+loop. Plain functions run in a worker thread, so a slow backup never blocks
+requests. A tick that comes round while the previous run is still going is
+skipped, not queued. stop() cancels the loops and waits for runs in progress.
+
+Given a lock_path, start() first takes an exclusive flock on that file, so
+only one process runs the jobs however many apps or workers share it.
+"""
+import asyncio
+import fcntl
+import os
+import random
+import time
+from datetime import datetime
+from typing import Callable, Dict, Optional
+
+
+class Job:
+    def __init__(self, name: str, func: Callable, interval: float, jitter: float):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.jitter = jitter
+        self.running: Optional[asyncio.Task] = None
+        self.runs = 0
+        self.failures = 0
+        self.skipped = 0
+        self.last_started: Optional[datetime] = None
+        self.last_duration: Optional[float] = None
+        self.max_duration = 0.0
+        self.total_duration = 0.0
+        self.last_error: Optional[str] = None
+        self.next_run: Optional[float] = None
+
+    def delay(self) -> float:
+        return max(0.0, self.interval * (1 + random.uniform(-self.jitter, self.jitter)))
+
+    async def execute(self):
+        self.last_started = datetime.now()
+        started = time.perf_counter()
+        try:
+            if asyncio.iscoroutinefunction(self.func):
+                await self.func()
+            else:
+                await asyncio.to_thread(self.func)
+            self.last_error = None
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.failures += 1
+            self.last_error = f"{type(e).__name__}: {e}"
+            print(f"Job {self.name} failed: {self.last_error}")
+        finally:
+            duration = time.perf_counter() - started
+            self.runs += 1
+            self.last_duration = duration
+            self.total_duration += duration
+            self.max_duration = max(self.max_duration, duration)
+
+    def metrics(self) -> dict:
+        return {
+            "interval": self.interval,
+            "running": self.running is not None and not self.running.done(),
+            "runs": self.runs,
+            "failures": self.failures,
+            "skipped": self.skipped,
+            "last_started": self.last_started.isoformat(timespec="seconds") if self.last_started else None,
+            "last_duration": round(self.last_duration, 3) if self.last_duration is not None else None,
+            "avg_duration": round(self.total_duration / self.runs, 3) if self.runs else None,
+            "max_duration": round(self.max_duration, 3),
+            "last_error": self.last_error,
+            "next_run_in": round(max(0.0, self.next_run - time.monotonic()), 1) if self.next_run else None,
+        }
+
+
+class Scheduler:
+    def __init__(self, lock_path: Optional[str] = None):
+        self.jobs: Dict[str, Job] = {}
+        self.lock_path = lock_path
+        self._lock_file = None
+        self._loops = []
+
+    def every(self, interval: float, func: Callable, name: Optional[str] = None, jitter: float = 0.1) -> Job:
+        job = Job(name or func.__name__, func, interval, jitter)
+        self.jobs[job.name] = job
+        return job
+
+    @property
+    def started(self) -> bool:
+        return bool(self._loops)
+
+    async def _loop(self, job: Job):
+        while True:
+            delay = job.delay()
+            job.next_run = time.monotonic() + delay
+            await asyncio.sleep(delay)
+            if job.running is not None and not job.running.done():
+                job.skipped += 1
+                continue
+            job.running = asyncio.create_task(job.execute(), name=f"job-{job.name}")
+
+    def _acquire_lock(self) -> bool:
+        if self.lock_path is None:
+            return True
+        os.makedirs(os.path.dirname(self.lock_path) or ".", exist_ok=True)
+        handle = open(self.lock_path, "w")
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            handle.close()
+            return False
+        self._lock_file = handle
+        return True
+
+    def start(self) -> bool:
+        """
+        Start the job loops. Returns False if another process holds the
+        lock and runs the jobs instead.
+        """
+        if self.started:
+            return True
+        if not self._acquire_lock():
+            return False
+        self._loops = [asyncio.create_task(self._loop(job), name=f"schedule-{job.name}") for job in self.jobs.values()]
+        return True
+
+    async def stop(self, timeout: float = 30):
+        """
+        Stop scheduling and give runs in progress up to `timeout` seconds to
+        finish. Threaded runs cannot be interrupted, so they are only waited on.
+        """
+        for loop in self._loops:
+            loop.cancel()
+        await asyncio.gather(*self._loops, return_exceptions=True)
+        self._loops = []
+        running = [job.running for job in self.jobs.values() if job.running is not None and not job.running.done()]
+        if running:
+            done, pending = await asyncio.wait(running, timeout=timeout)
+            for task in pending:
+                task.cancel()
+        if self._lock_file is not None:
+            # Closing the file releases the flock
+            self._lock_file.close()
+            self._lock_file = None
+
+    def metrics(self) -> dict:
+        return {name: job.metrics() for name, job in self.jobs.items()}
@@ -0,0 +1,161 @@
+"""
+Pilgrim search by ITS, name or passport number.
+
+Names and passport numbers live in the master_search FTS5 table, which
+uses the trigram tokenizer. Triggers on master (see database.py) queue
+changed rows in master_search_pending and each writer applies the queue
+before it commits, so searching only reads.
+
+A query is answered in up to three steps:
+
+1. A number is looked up as an ITS.
+2. Every word of the query must occur as a substring, which covers prefixes
+   and partial names ("faz hal").
+3. If step 2 finds too few rows, the query is fuzzy: rows sharing any
+   trigram of the query words are fetched, best bm25 first, and reranked by
+   string similarity. This finds "Fazela Halai" when the record says
+   "Fazila Halai". Trigrams found in thousands of rows ("bha" from "bhai")
+   say little and make ranking slow, so they are dropped before the OR
+   query. Fuzzy hits below SEARCH_MIN_SCORE are discarded.
+"""
+import os
+import re
+from difflib import SequenceMatcher
+from typing import List
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from database import SEARCH_SYNC, fetch_master
+
+SEARCH_LIMIT = int(os.getenv("SEARCH_LIMIT", 20))
+# Rows fetched from the index before reranking
+SEARCH_CANDIDATES = int(os.getenv("SEARCH_CANDIDATES", 200))
+# Trigrams found in more rows than this are ignored by fuzzy search
+SEARCH_COMMON_TRIGRAM = int(os.getenv("SEARCH_COMMON_TRIGRAM", 2000))
+# At most this many of the rarest trigrams go into the fuzzy query
+SEARCH_FUZZY_TRIGRAMS = int(os.getenv("SEARCH_FUZZY_TRIGRAMS", 12))
+# Fuzzy hits scoring below this are noise, not misspellings
+SEARCH_MIN_SCORE = float(os.getenv("SEARCH_MIN_SCORE", 0.6))
+
+# Substring matches are reranked in Python anyway, so they skip bm25 and
+# stop after `limit` rows however common the words are. Both join master,
+# so a row the index still holds for a deleted pilgrim is never returned.
+SUBSTRING_SQL = text(
+    "SELECT s.rowid AS ITS, s.name, s.passport_No FROM master_search AS s JOIN master AS m ON m.ITS = s.rowid "
+    "WHERE master_search MATCH :query LIMIT :limit"
+)
+RANKED_SQL = text(
+    "SELECT s.rowid AS ITS, s.name, s.passport_No FROM master_search AS s JOIN master AS m ON m.ITS = s.rowid "
+    "WHERE master_search MATCH :query ORDER BY s.rank LIMIT :limit"
+)
+# Counts the rows holding a term, but stops once it is known to be common
+TERM_ROWS_SQL = text(
+    "SELECT count(*) FROM (SELECT 1 FROM master_search WHERE master_search MATCH :query LIMIT :limit)"
+)
+
+
+def sync_search_index(db: Session) -> int:
+    """
+    Re-index the masters queued by the triggers and commit. For writers
+    that bypass the ORM session events. Returns how many were queued.
+    """
+    pending = db.execute(text("SELECT count(*) FROM master_search_pending")).scalar()
+    if pending:
+        for statement in SEARCH_SYNC:
+            db.execute(text(statement))
+    db.commit()
+    return pending
+
+
+def query_words(query: str) -> List[str]:
+    return re.findall(r"\w+", query.lower())
+
+
+def trigrams(word: str) -> set:
+    return {word[i:i + 3] for i in range(len(word) - 2)}
+
+
+def _quote(term: str) -> str:
+    return '"' + term.replace('"', '""') + '"'
+
+
+def _match(db: Session, statement, query: str, limit: int) -> list:
+    return db.execute(statement, {"query": query, "limit": limit}).mappings().all()
+
+
+def rare_trigrams(db: Session, grams: set) -> list:
+    """
+    The trigrams that occur in at least one row but no more than
+    SEARCH_COMMON_TRIGRAM rows, rarest first.
+    """
+    counts = {}
+    for gram in grams:
+        rows = db.execute(TERM_ROWS_SQL, {"query": _quote(gram), "limit": SEARCH_COMMON_TRIGRAM + 1}).scalar()
+        if 0 < rows <= SEARCH_COMMON_TRIGRAM:
+            counts[gram] = rows
+    return sorted(counts, key=counts.get)[:SEARCH_FUZZY_TRIGRAMS]
+
+
+def similarity(words: List[str], row) -> float:
+    """
+    Mean, over the query words, of the best match against any word of the
+    row's name or passport number (1.0 is an exact word).
+    """
+    candidates = query_words(f"{row['name']} {row['passport_No'] or ''}")
+    if not candidates:
+        return 0.0
+    total = 0.0
+    matcher = SequenceMatcher(autojunk=False)
+    for word in words:
+        # SequenceMatcher caches what it learns about seq2, so the query word goes there
+        matcher.set_seq2(word)
+        best = 0.0
+        for candidate in candidates:
+            if candidate.startswith(word):
+                best = max(best, 1.0 if candidate == word else 0.9)
+                continue
+            matcher.set_seq1(candidate)
+            # Cheap upper bounds first; most candidates stop here
+            if matcher.real_quick_ratio() > best and matcher.quick_ratio() > best:
+                best = max(best, matcher.ratio())
+        total += best
+    return total / len(words)
+
+
+def search_masters(db: Session, query: str, limit: int = SEARCH_LIMIT) -> List[dict]:
+    query = query.strip()
+    results = {}
+    if query.isdigit():
+        master = fetch_master(db, int(query))
+        if master:
+            name = " ".join(part for part in (master.first_name, master.middle_name, master.last_name) if part)
+            results[master.ITS] = {"ITS": master.ITS, "name": name, "passport_No": master.passport_No, "score": 1.0, "match": "its"}
+
+    # The trigram index can't match words shorter than three characters
+    words = [word for word in query_words(query) if len(word) >= 3]
+    if not words:
+        return list(results.values())[:limit]
+
+    candidates = {}
+    for row in _match(db, SUBSTRING_SQL, " AND ".join(_quote(word) for word in words), SEARCH_CANDIDATES):
+        candidates[row["ITS"]] = (row, "substring")
+    # A number that is an ITS needs no fuzzy matching
+    if len(candidates) < limit and not results:
+        grams = set().union(*(trigrams(word) for word in words))
+        rare = rare_trigrams(db, grams)
+        if rare:
+            for row in _match(db, RANKED_SQL, " OR ".join(_quote(gram) for gram in rare), SEARCH_CANDIDATES):
+                candidates.setdefault(row["ITS"], (row, "fuzzy"))
+
+    ranked = []
+    for its, (row, match) in candidates.items():
+        if its in results:
+            continue
+        score = similarity(words, row)
+        if match == "fuzzy" and score < SEARCH_MIN_SCORE:
+            continue
+        ranked.append({"ITS": its, "name": row["name"], "passport_No": row["passport_No"], "score": round(score, 3), "match": match})
+    # Rows with every word found verbatim stay ahead of fuzzy hits
+    ranked.sort(key=lambda result: (result["match"] == "substring", result["score"]), reverse=True)
+    return (list(results.values()) + ranked)[:limit]
@@ -0,0 +1,79 @@
+"""
+All desks in one application.
+
+Each desk module exposes an APIRouter; this module mounts the desks listed
+in DESKS under their prefix, so one process (or several workers) replaces
+the seven separate apps:
+
+    DESKS=customs,sim uvicorn service:app --workers 4
+    gunicorn service:app -k uvicorn.workers.UvicornWorker -w 4 --preload
+
+Every worker shares the pool settings from database.py (DB_POOL_*) and
+the session key from auth.py (SESSION_SECRET or SESSION_SECRET_FILE), so a
+session issued by one worker is accepted by the others. main is included
+last because its /{its} route matches any single path segment.
+"""
+import importlib
+import os
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI
+from fastapi.staticfiles import StaticFiles
+
+from common import desk_app
+
+# Desk name -> (module, prefix). The module is imported only when the desk
+# is enabled.
+DESKS = {
+    "customs": ("custom", "/customs"),
+    "sim": ("sim", "/sim"),
+    "arrival": ("arrrived", "/arrival"),
+    "admin": ("admin", "/admin"),
+    "delete": ("delete", "/delete"),
+    "backup": ("temp", "/backup"),
+    "main": ("main", ""),
+}
+
+ENABLED_DESKS = [name.strip() for name in os.getenv("DESKS", ",".join(DESKS)).split(",") if name.strip()]
+
+def load_desks(names):
+    unknown = [name for name in names if name not in DESKS]
+    if unknown:
+        raise ValueError(f"Unknown desks in DESKS: {', '.join(unknown)}")
+    modules = {}
+    for name in names:
+        module_name, _ = DESKS[name]
+        modules[name] = importlib.import_module(module_name)
+    return modules
+
+
+desks = load_desks(ENABLED_DESKS)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # The scheduler's lock file lets only one worker run the backups
+    if "backup" in desks:
+        desks["backup"].scheduler.start()
+    yield
+    if "backup" in desks:
+        await desks["backup"].scheduler.stop()
+
+
+def create_app() -> FastAPI:
+    app = FastAPI(lifespan=lifespan)
+    app.mount("/static", StaticFiles(directory="static"), name="static")
+    for name, module in desks.items():
+        _, prefix = DESKS[name]
+        if prefix:
+            app.mount(prefix, desk_app(module.router, static=False), name=name)
+    if "main" in desks:
+        app.include_router(desks["main"].router)
+    return app
+
+
+app = create_app()
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run("service:app", host="0.0.0.0", port=int(os.getenv("PORT", 8000)), workers=int(os.getenv("WEB_CONCURRENCY", 1)))
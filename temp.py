@@ -1,88 +1,102 @@
 import os
-import time
-import schedule
-import sqlite3
+from typing import Optional
 from datetime import datetime
-from sqlalchemy import create_engine, MetaData
-from sqlalchemy.orm import sessionmaker
-import threading
-from fastapi import FastAPI, HTTPException
-
-DATABASE_URL = os.getenv("DATABASE_URL")
-BACKUP_DIR = 'backups'
-
-def get_engine():
-    return create_engine(DATABASE_URL)
-
-def backup_table(engine, table_name):
-    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-    backup_file = os.path.join(BACKUP_DIR, f"{table_name}_backup_{timestamp}.sql")
-
-    with sqlite3.connect(engine.url.database) as conn:
-        with open(backup_file, 'w') as f:
-            for line in conn.iterdump():
-                if line.startswith(f'INSERT INTO "{table_name}"'):
-                    f.write(f'{line}\n')
-
-    print(f"Backup for table {table_name} created at {backup_file}")
-
-def backup_database():
-    if not os.path.exists(BACKUP_DIR):
-        os.makedirs(BACKUP_DIR)
-
-    engine = get_engine()
-    metadata = MetaData()
-    metadata.reflect(bind=engine)
-
-    for table_name in metadata.tables.keys():
-        backup_table(engine, table_name)
-
-schedule.every(1).minutes.do(backup_database)
-
-def restore_table(engine, table_name, backup_file):
-    with sqlite3.connect(engine.url.database) as conn:
-        cursor = conn.cursor()
-        
-        # Remove existing data from the table
-        cursor.execute(f'DELETE FROM "{table_name}";')
-        
-        # Restore data from the backup file
-        with open(backup_file, 'r') as f:
-            sql_script = f.read()
-            conn.executescript(sql_script)
-
-    print(f"Data for table {table_name} restored from {backup_file}")
-
-
-def run_scheduler():
-    while True:
-        schedule.run_pending()
-        time.sleep(1)
-
-app = FastAPI()
-
-@app.on_event("startup")
-def startup_event():
-    backup_thread = threading.Thread(target=run_scheduler)
-    backup_thread.start()
-
-@app.post("/restore-table/")
-async def restore_table_endpoint(table_name: str, backup_file: str):
-    engine = get_engine()
-    if not os.path.exists(backup_file):
-        raise HTTPException(status_code=404, detail="Backup file not found")
-    
+from contextlib import asynccontextmanager
+from fastapi import APIRouter, FastAPI, HTTPException
+
+from backup import BACKUP_DIR, create_snapshot, restore_tables, list_snapshots, write_columnar_snapshot, list_columnar, restore_tables_columnar, diff_snapshots
+from scheduler import Scheduler
+
+BACKUP_INTERVAL = float(os.getenv("BACKUP_INTERVAL", 60))
+BACKUP_JITTER = float(os.getenv("BACKUP_JITTER", 0.1))
+# Only one process may run the backup job, whether it is this app, a
+# service.py worker or both
+SCHEDULER_LOCK = os.getenv("SCHEDULER_LOCK", os.path.join(BACKUP_DIR, ".scheduler.lock"))
+
+RESTORE_SOURCES = {"pages": restore_tables, "columnar": restore_tables_columnar}
+
+
+def backup_job():
+    # Page-level incremental snapshot; skipped when nothing was committed.
+    # Each new chain also gets a compact columnar dump for long-term keeping.
+    snapshot = create_snapshot()
+    if snapshot and snapshot["kind"] == "full":
+        write_columnar_snapshot(snapshot["id"])
+
+
+scheduler = Scheduler(lock_path=SCHEDULER_LOCK)
+scheduler.every(BACKUP_INTERVAL, backup_job, name="backup", jitter=BACKUP_JITTER)
+
+router = APIRouter()
+
+@router.post("/restore-table/")
+def restore_table_endpoint(table_name: str, snapshot: Optional[str] = None, at: Optional[datetime] = None, source: str = "pages"):
+    # table_name may list several tables (comma separated); they are restored together
+    if snapshot and at:
+        raise HTTPException(status_code=400, detail="Pass either snapshot or at, not both")
+    if source not in RESTORE_SOURCES:
+        raise HTTPException(status_code=400, detail=f"Unknown restore source {source}")
+    table_names = [name.strip() for name in table_name.split(",") if name.strip()]
     try:
-        restore_table(engine, table_name, backup_file)
+        result = RESTORE_SOURCES[source](table_names, snapshot, at)
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    
-    return {"message": f"Table {table_name} restored successfully from {backup_file}"}
 
-@app.get("/")
+    return {"message": f"Table {table_name} restored successfully from snapshot {result['snapshot']}", **result}
+
+@router.get("/snapshots/")
+def get_snapshots():
+    return {"snapshots": list_snapshots()}
+
+@router.get("/snapshots/columnar/")
+def get_columnar_snapshots():
+    return {"dumps": list_columnar()}
+
+@router.post("/snapshots/columnar/")
+def post_columnar_snapshot(snapshot: Optional[str] = None, compression: Optional[str] = None):
+    try:
+        return write_columnar_snapshot(snapshot, compression)
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except (ValueError, RuntimeError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/snapshots/diff/")
+def get_snapshot_diff(table_name: str, key: str, old: str, new: Optional[str] = None, limit: int = 100):
+    try:
+        diff = diff_snapshots(table_name, key, old, new)
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    # Counts are exact; the key lists are cut at `limit`
+    for change in ("added", "removed", "changed"):
+        diff[f"{change}_count"] = len(diff[change])
+        diff[change] = diff[change][:limit]
+    return diff
+
+@router.get("/scheduler/metrics/")
+async def get_scheduler_metrics():
+    # Only the process that owns the scheduler reports runs
+    return {"started": scheduler.started, "jobs": scheduler.metrics()}
+
+@router.get("/")
 async def root():
     return {"message": "Hello World"}
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    scheduler.start()
+    yield
+    await scheduler.stop()
+
+app = FastAPI(lifespan=lifespan)
+app.include_router(router)
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT", 3000)))